@@ -0,0 +1,381 @@
+"""asyncio upload engine for driveuploader.
+
+Carries out the plan of an Uploader over aiohttp instead of a pool of
+threads, so hundreds of files can be in flight on a single thread.
+Planning, the upload session journal, the folder and remote indexes, the
+rate limiter and the retry policy are the Uploader's own; only the
+transfers are sent differently, and every file gets the same FileResult
+as with the thread engine.
+
+File reads, the session journal and the index writes block, so they
+run on the loop's default executor while other transfers go on.
+
+Requires Python 3.5 or later and aiohttp.
+"""
+import asyncio
+import json
+import mimetypes
+
+import aiohttp
+import httplib2
+from apiclient.errors import HttpError
+
+import driveuploader
+
+
+FILES_PATH = 'drive/v3/files'
+UPLOAD_PATH = 'upload/drive/v3/files'
+RESUME_INCOMPLETE = driveuploader.RESUME_INCOMPLETE
+# API method sending media with each HTTP method, as counted by --timings.
+METHOD_IDS = {'POST': 'drive.files.create', 'PATCH': 'drive.files.update'}
+# Transport errors of aiohttp, retried like those of httplib2.
+TRANSPORT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+RETRYABLE_ERRORS = driveuploader.RETRYABLE_ERRORS + TRANSPORT_ERRORS
+
+
+class AsyncEngine(object):
+    """Carries out the PlanActions of uploader with asyncio. At most
+    uploader.jobs files are in flight, over at most --max_per_host
+    connections.
+    """
+
+    def __init__(self, uploader):
+        self.uploader = uploader
+        self.files_url = uploader.api_url + FILES_PATH
+        self.upload_url = uploader.api_url + UPLOAD_PATH
+        self.session = None
+        self._token_lock = None
+
+    def run(self, actions):
+        """Carry out actions and return their FileResults, in order.
+
+        :type actions: list[driveuploader.PlanAction]
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.run_actions(actions))
+        finally:
+            loop.close()
+
+    async def run_actions(self, actions):
+        uploader = self.uploader
+        self._token_lock = asyncio.Lock()
+        results = [None] * len(actions)
+        order = list(range(len(actions)))
+        if uploader.order != driveuploader.FIFO:
+            sizes = [driveuploader.transfer_size(action) for action in actions]
+            order.sort(key=sizes.__getitem__,
+                       reverse=uploader.order == driveuploader.LARGEST_FIRST)
+        # A semaphore bounds the files in flight; tasks are started in
+        # order as slots free up, so a long plan never becomes
+        # thousands of waiting tasks.
+        slots = asyncio.Semaphore(uploader.jobs)
+
+        async def carry_out(index):
+            try:
+                results[index] = await self.execute_action(actions[index])
+            except Exception as error:
+                # Anything execute_action let through fails this file
+                # only; the results of the others are kept.
+                results[index] = driveuploader.failed_result(
+                    actions[index].filepath, error)
+            finally:
+                slots.release()
+
+        pool = uploader.pool
+        connector = aiohttp.TCPConnector(
+            limit=pool.max_per_host, limit_per_host=pool.max_per_host)
+        timeout = aiohttp.ClientTimeout(sock_connect=pool.timeout,
+                                        sock_read=pool.timeout)
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=timeout) as session:
+            self.session = session
+            tasks = []
+            for index in order:
+                await slots.acquire()
+                tasks.append(asyncio.ensure_future(carry_out(index)))
+            if tasks:
+                await asyncio.wait(tasks)
+        return results
+
+    async def execute_action(self, action):
+        """The asyncio counterpart of Uploader.execute_action.
+
+        :type action: driveuploader.PlanAction
+        """
+        uploader = self.uploader
+        result = driveuploader.settled_result(action)
+        if result is not None:
+            return result
+        try:
+            file_class = await self.blocking(uploader.load_file, action)
+            if action.action == driveuploader.UPDATE:
+                with uploader.phase('update', action.filepath):
+                    status = await self.update_file(file_class)
+            else:
+                if action.action == driveuploader.BACKUP:
+                    with uploader.phase('backup', action.filepath):
+                        await self.backup_file(file_class)
+                with uploader.phase('upload', action.filepath):
+                    status = await self.upload_file(file_class)
+        except driveuploader.FILE_ERRORS + TRANSPORT_ERRORS as error:
+            return driveuploader.failed_result(action.filepath, error)
+        return driveuploader.FileResult(
+            action.filepath, status, None,
+            file_class.size - file_class.resumed_bytes)
+
+    async def backup_file(self, file_class):
+        uploader = self.uploader
+        file_id = file_class.file_found['id']
+        url = '{}/{}'.format(self.files_url, file_id)
+        try:
+            await self.request('PATCH', url, 'drive.files.update',
+                               json={'name': file_class.filename,
+                                     'properties': {'no_overwrite': 'true'}})
+        except HttpError as error:
+            if not uploader.is_stale(error):
+                raise
+            await self.blocking(uploader.drop_stale, file_id,
+                                file_class.folder_id, file_class.filename)
+            return
+        await self.blocking(uploader.mark_backed_up, file_id,
+                            file_class.folder_id, file_class.filename)
+
+    async def update_file(self, file_class):
+        uploader = self.uploader
+        file_id = file_class.file_found['id']
+        try:
+            drive_file = await self.send_media(
+                'PATCH', '{}/{}'.format(self.upload_url, file_id), file_class,
+                file_class.file_metadata, file_id)
+        except HttpError as error:
+            if not uploader.is_stale(error):
+                raise
+            await self.blocking(uploader.drop_stale, file_id,
+                                file_class.folder_id, file_class.filename)
+            return await self.upload_file(file_class)
+        return await self.blocking(uploader.file_updated, file_class,
+                                   drive_file)
+
+    async def upload_file(self, file_class):
+        uploader = self.uploader
+        drive_file = await self.send_media(
+            'POST', self.upload_url, file_class,
+            uploader.create_metadata(file_class), file_class.folder_id)
+        return await self.blocking(uploader.file_created, file_class,
+                                   drive_file)
+
+    async def send_media(self, method, url, file_class, metadata, target):
+        """Send metadata and the content of file_class to url, in one
+        multipart request or, above resumable_threshold, as a resumable
+        upload. Return the Drive file.
+
+        :type method: str
+        :type url: str
+        :type file_class: driveuploader.LocalFile
+        :type metadata: dict
+        :type target: str
+        """
+        uploader = self.uploader
+        method_id = METHOD_IDS[method]
+        mimetype = (uploader.mimetype or
+                    mimetypes.guess_type(file_class.filepath)[0] or
+                    'application/octet-stream')
+        if file_class.size > uploader.resumable_threshold:
+            return await self.send_resumable(method, url, file_class,
+                                             metadata, target, mimetype)
+        content = await self.blocking(read_file, file_class.filepath)
+
+        def body():
+            writer = aiohttp.MultipartWriter('related')
+            writer.append_json(metadata)
+            writer.append(content, {'Content-Type': mimetype})
+            return writer
+
+        _, _, reply = await self.request(
+            method, url, method_id, body=body,
+            params={'uploadType': 'multipart',
+                    'fields': uploader.mirror_fields})
+        return json.loads(reply.decode('utf-8'))
+
+    async def send_resumable(self, method, url, file_class, metadata,
+                             target, mimetype):
+        """Upload file_class in chunk_size pieces through a resumable
+        upload session, journaled like Uploader.execute_media does, so
+        either engine can resume the other's interrupted upload.
+        """
+        uploader = self.uploader
+        method_id = METHOD_IDS[method]
+        size = file_class.size
+        key = file_class.session_key()
+        session = await self.blocking(uploader.sessions.get, key, target)
+        uri = None
+        if session:
+            print("Resuming upload of {} from byte {}.".format(
+                file_class.filepath, session['offset']))
+            try:
+                offset, drive_file = await self.session_status(
+                    session['uri'], size, method_id)
+            except HttpError as error:
+                if error.resp.status not in (404, 410):
+                    raise
+                print("Upload session of {} expired, starting "
+                      "over.".format(file_class.filepath))
+            else:
+                file_class.resumed_bytes = offset
+                if drive_file is not None:
+                    file_class.resumed_bytes = size
+                    await self.blocking(uploader.sessions.remove, key)
+                    return drive_file
+                uri = session['uri']
+        if uri is None:
+            _, headers, _ = await self.request(
+                method, url, method_id, json=metadata,
+                params={'uploadType': 'resumable',
+                        'fields': uploader.mirror_fields},
+                headers={'X-Upload-Content-Type': mimetype,
+                         'X-Upload-Content-Length': str(size)})
+            uri = headers['Location']
+            offset = 0
+        attempt = 0
+        with open(file_class.filepath, 'rb') as media:
+            while True:
+                chunk = await self.blocking(read_chunk, media, offset,
+                                            uploader.chunk_size)
+                content_range = 'bytes {}-{}/{}'.format(
+                    offset, offset + len(chunk) - 1, size)
+                try:
+                    status, headers, reply = await self.request(
+                        'PUT', uri, method_id, data=chunk, retry=False,
+                        headers={'Content-Range': content_range},
+                        expect=(200, 201, RESUME_INCOMPLETE))
+                except RETRYABLE_ERRORS as error:
+                    if (attempt >= uploader.retries or
+                            not is_retryable(error)):
+                        raise
+                    await asyncio.sleep(uploader.retry_delay(attempt, error))
+                    attempt += 1
+                    # Ask which bytes Drive has before sending more.
+                    offset, drive_file = await self.session_status(
+                        uri, size, method_id)
+                    if drive_file is not None:
+                        break
+                    continue
+                if status != RESUME_INCOMPLETE:
+                    drive_file = json.loads(reply.decode('utf-8'))
+                    break
+                attempt = 0
+                offset = committed_bytes(headers)
+                await self.blocking(uploader.sessions.save, key, target, uri,
+                                    offset)
+        await self.blocking(uploader.sessions.remove, key)
+        return drive_file
+
+    async def session_status(self, uri, size, method_id):
+        """Return (offset, None) for the upload session uri, or (size,
+        drive_file) if the upload is complete.
+        """
+        status, headers, reply = await self.request(
+            'PUT', uri, method_id,
+            headers={'Content-Range': 'bytes */{}'.format(size)},
+            expect=(200, 201, RESUME_INCOMPLETE))
+        if status == RESUME_INCOMPLETE:
+            return committed_bytes(headers), None
+        return size, json.loads(reply.decode('utf-8'))
+
+    async def request(self, method, url, method_id, body=None, retry=True,
+                      expect=(200,), **kwargs):
+        """Send a request of the API method method_id with the
+        uploader's rate limiter and, unless retry is False, its retry
+        policy. Return (status, headers, body) of the response, or raise
+        HttpError if its status is not in expect. body, if given, makes
+        the request body for each attempt.
+        """
+        uploader = self.uploader
+        attempt = 0
+        while True:
+            wait = uploader.throttle_delay()
+            if wait:
+                await asyncio.sleep(wait)
+            if body is not None:
+                kwargs['data'] = body()
+            uploader.count_call(method_id)
+            try:
+                return await self.send(method, url, expect, **kwargs)
+            except RETRYABLE_ERRORS as error:
+                if (not retry or attempt >= uploader.retries or
+                        not is_retryable(error)):
+                    raise
+                await asyncio.sleep(uploader.retry_delay(attempt, error))
+                attempt += 1
+
+    async def send(self, method, url, expect, headers=None, **kwargs):
+        headers = dict(headers or {})
+        for refresh in (False, True):
+            token = await self.access_token()
+            headers['Authorization'] = 'Bearer ' + token
+            async with self.session.request(method, url, headers=headers,
+                                            allow_redirects=False,
+                                            **kwargs) as response:
+                reply = await response.read()
+                if response.status == 401 and not refresh:
+                    await self.access_token(expired=token)
+                    continue
+                if response.status not in expect:
+                    raise HttpError(
+                        httplib2.Response({'status': response.status}),
+                        reply, uri=url)
+                return response.status, response.headers, reply
+
+    async def blocking(self, function, *args):
+        """Return function(*args), called on the default executor as
+        it does file or database I/O.
+        """
+        return await asyncio.get_event_loop().run_in_executor(
+            None, function, *args)
+
+    async def access_token(self, expired=None):
+        """Return a valid access token of the uploader's credentials,
+        refreshing it (off the event loop) when it has expired or is the
+        token expired that Drive just rejected.
+        """
+        credentials = self.uploader.credentials
+        async with self._token_lock:
+            if (credentials.access_token is None or
+                    credentials.access_token == expired or
+                    credentials.access_token_expired):
+                http = httplib2.Http(timeout=self.uploader.pool.timeout)
+                await self.blocking(credentials.refresh, http)
+            return credentials.access_token
+
+
+def is_retryable(error):
+    """Return True for the errors the Uploader retries and for aiohttp
+    transport errors.
+
+    :type error: Exception
+    """
+    return (isinstance(error, TRANSPORT_ERRORS) or
+            driveuploader.is_retryable(error))
+
+
+def read_file(path):
+    """Return the content of the file path."""
+    with open(path, 'rb') as media:
+        return media.read()
+
+
+def read_chunk(media, offset, size):
+    """Return up to size bytes of the open file media from offset."""
+    media.seek(offset)
+    return media.read(size)
+
+
+def committed_bytes(headers):
+    """Return the number of bytes an upload session has committed,
+    from the Range header of a 308 response.
+    """
+    committed = headers.get('Range')
+    if not committed:
+        return 0
+    return int(committed.rsplit('-', 1)[-1]) + 1
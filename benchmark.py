@@ -0,0 +1,379 @@
+"""Benchmarks for driveuploader.
+
+hashing: compare serial and parallel MD5 hashing (--checksum,
+--hash_workers) over a synthetic tree of files.
+
+    python benchmark.py hashing --files 200 --size 4M --workers 4
+
+upload: time Uploader.upload end to end against a fakedrive.FakeDrive
+with a simulated round-trip time and bandwidth, over a synthetic tree of
+many tiny files, a few huge files or a mix of both.
+
+    python benchmark.py upload --tree mixed --rtt 0.05 --bandwidth 20M \
+        --jobs 8 --json after.json
+
+compare: print the change of every metric between two --json results.
+
+    python benchmark.py compare before.json after.json
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import driveuploader
+import fakedrive
+
+TREES = ('tiny', 'huge', 'mixed')
+TREE_FILES = {'tiny': 1000, 'huge': 4, 'mixed': 200}  # default file counts
+TINY_SIZES = (1, 16 * 1024)
+HUGE_SIZE = 64 * 1024 * 1024
+MIXED_LARGE_SHARE = 0.05  # files of a mixed tree drawn from LARGE_SIZES
+MIXED_SMALL_SIZES = (1024, 1024 * 1024)
+MIXED_LARGE_SIZES = (8 * 1024 * 1024, 64 * 1024 * 1024)
+
+
+def make_tree(root, sizes):
+    """Write a file of random bytes under root for every size in sizes
+    and return their paths.
+
+    :type root: str
+    :type sizes: list[int]
+    """
+    paths = []
+    for number, size in enumerate(sizes):
+        path = os.path.join(root, 'file{:06d}.bin'.format(number))
+        with open(path, 'wb') as synthetic:
+            remaining = size
+            while remaining:
+                block = min(remaining, driveuploader.HASH_BLOCK_SIZE)
+                synthetic.write(os.urandom(block))
+                remaining -= block
+        paths.append(path)
+    return paths
+
+
+def tree_sizes(tree, count, seed=0):
+    """Return the file sizes of a synthetic tree: 'tiny' files of up to
+    16K, 'huge' files of 64M, or a 'mixed' tree of mostly small files
+    (1K to 1M) and a few large ones (8M to 64M). Sizes are spread
+    log-uniformly and the same seed gives the same tree.
+
+    :type tree: str
+    :type count: int
+    :type seed: int
+    """
+    generator = random.Random(seed)
+
+    def log_uniform(low, high):
+        return int(math.exp(generator.uniform(math.log(low),
+                                              math.log(high))))
+
+    if tree == 'tiny':
+        return [log_uniform(*TINY_SIZES) for _ in range(count)]
+    if tree == 'huge':
+        return [HUGE_SIZE] * count
+    return [log_uniform(*(MIXED_LARGE_SIZES
+                          if generator.random() < MIXED_LARGE_SHARE
+                          else MIXED_SMALL_SIZES))
+            for _ in range(count)]
+
+
+def bench_hashing(paths, workers):
+    """Hash paths serially, then with a pool of workers processes, and
+    return the timings of both.
+
+    :type paths: list[str]
+    :type workers: int
+    """
+    start = time.time()
+    serial = [driveuploader.file_md5(path) for path in paths]
+    serial_time = time.time() - start
+
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parallel = list(executor.map(driveuploader.file_md5, paths))
+    parallel_time = time.time() - start
+
+    assert serial == parallel
+    total = sum(os.path.getsize(path) for path in paths)
+    return {
+        'files': len(paths),
+        'bytes': total,
+        'workers': workers,
+        'serial_seconds': serial_time,
+        'parallel_seconds': parallel_time,
+        'speedup': serial_time / parallel_time if parallel_time else None,
+    }
+
+
+def print_hashing(result):
+    megabytes = result['bytes'] / 1024.0 / 1024.0
+    print("{} files, {:.1f} MB".format(result['files'], megabytes))
+    print("  serial:              {:8.3f}s {:8.1f} MB/s".format(
+        result['serial_seconds'], megabytes / result['serial_seconds']))
+    print("  parallel ({:2d} procs): {:8.3f}s {:8.1f} MB/s".format(
+        result['workers'], result['parallel_seconds'],
+        megabytes / result['parallel_seconds']))
+    print("  speedup: {:.2f}x".format(result['speedup']))
+
+
+def bench_upload(root, paths, rtt, bandwidth, **options):
+    """Upload paths to a FakeDrive with rtt seconds of latency per API
+    call and bandwidth bytes per second, and return the throughput,
+    API calls and peak memory of the run.
+
+    :type root: str
+    :type paths: list[str]
+    :type rtt: float
+    :type bandwidth: int | None
+    """
+    # Keep the session journal and caches of the run out of the repo.
+    driveuploader.SCRIPT_DIR = tempfile.mkdtemp(prefix='driveuploader-state-')
+    drive = fakedrive.FakeDrive(latency=rtt, bandwidth=bandwidth)
+    try:
+        with drive:
+            uploader = driveuploader.Uploader(
+                file_list=','.join(os.path.basename(path) for path in paths),
+                home_dir=root,
+                folder='benchmark',
+                api_url=drive.url,
+                credentials=drive.credentials(),
+                **options)
+            drive.calls.clear()
+            start = time.time()
+            with quiet():
+                results = uploader.upload()
+            seconds = time.time() - start
+            calls = dict(drive.calls)
+            connections = drive.connections
+    finally:
+        shutil.rmtree(driveuploader.SCRIPT_DIR)
+    total = sum(os.path.getsize(path) for path in paths)
+    api_calls = sum(count for method, count in calls.items()
+                    if method != 'batch')
+    return {
+        'files': len(paths),
+        'bytes': total,
+        'seconds': seconds,
+        'files_per_second': len(paths) / seconds,
+        'mb_per_second': total / 1024.0 / 1024.0 / seconds,
+        'api_calls': api_calls,
+        'api_calls_per_file': float(api_calls) / len(paths),
+        'http_batches': calls.get('batch', 0),
+        'connections': connections,
+        'failed': sum(1 for result in results
+                      if result.status == driveuploader.FAILED),
+        'peak_rss': peak_rss(),
+        'calls': calls,
+    }
+
+
+class quiet(object):
+    """Context manager silencing stdout, for the per-file messages of
+    an upload.
+    """
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in bytes, or
+    None where it isn't known. The fake server runs in this process,
+    so its memory is included.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def print_upload(result):
+    megabytes = result['bytes'] / 1024.0 / 1024.0
+    print("{} files, {:.1f} MB in {:.2f}s".format(
+        result['files'], megabytes, result['seconds']))
+    print("  {:10.1f} files/s".format(result['files_per_second']))
+    print("  {:10.2f} MB/s".format(result['mb_per_second']))
+    print("  {:10.2f} API calls per file ({} calls, {} batches)".format(
+        result['api_calls_per_file'], result['api_calls'],
+        result['http_batches']))
+    print("  {:10d} connections".format(result['connections']))
+    if result['peak_rss'] is not None:
+        print("  {:10.1f} MB peak RSS".format(
+            result['peak_rss'] / 1024.0 / 1024.0))
+    if result['failed']:
+        print("  {} files failed".format(result['failed']))
+
+
+def write_result(path, benchmark, args, result):
+    """Write a benchmark result with its parameters, the commit and the
+    Python version to path as JSON.
+
+    :type path: str
+    :type benchmark: str
+    :type args: argparse.Namespace
+    :type result: dict
+    """
+    parameters = dict((name, value) for name, value in vars(args).items()
+                      if name not in ('command', 'json'))
+    with open(path, 'w') as output:
+        json.dump({'benchmark': benchmark,
+                   'commit': git_commit(),
+                   'python': platform.python_version(),
+                   'parameters': parameters,
+                   'result': result}, output, indent=2, sort_keys=True)
+        output.write('\n')
+
+
+def git_commit():
+    """Return the commit checked out next to this script, or None."""
+    try:
+        output = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w'))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('ascii').strip()
+
+
+def compare(before_path, after_path):
+    """Print every numeric result of two --json outputs of the same
+    benchmark, and how much it changed.
+
+    :type before_path: str
+    :type after_path: str
+    """
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    if before['benchmark'] != after['benchmark']:
+        sys.exit("Can't compare a {} benchmark with a {} one.".format(
+            before['benchmark'], after['benchmark']))
+    if before['parameters'] != after['parameters']:
+        print("Warning: the benchmarks were run with different parameters.")
+    print("{:22} {:>14} {:>14} {:>8}".format(
+        'metric', before['commit'] or before_path,
+        after['commit'] or after_path, 'change'))
+    for name in sorted(set(before['result']) & set(after['result'])):
+        old, new = before['result'][name], after['result'][name]
+        if (isinstance(old, bool) or not isinstance(old, (int, float)) or
+                not isinstance(new, (int, float))):
+            continue
+        change = '{:+.1%}'.format((new - old) / float(old)) if old else ''
+        print("{:22} {:14.6g} {:14.6g} {:>8}".format(name, old, new, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    hashing = commands.add_parser(
+        'hashing', help="Serial vs. parallel hashing of a synthetic tree.")
+    hashing.add_argument("--files", type=int, default=200,
+                         help="Number of files (default 200).")
+    hashing.add_argument("--size", type=driveuploader.parse_bytes,
+                         default=4 * 1024 * 1024,
+                         help="Size of every file, e.g. 64K or 4M "
+                              "(default 4M).")
+    hashing.add_argument("--workers", type=int,
+                         default=os.cpu_count() if hasattr(os, 'cpu_count')
+                         else 4,
+                         help="Hashing processes (default: CPU count).")
+    hashing.add_argument("--json", metavar='PATH',
+                         help="Also write the result to PATH as JSON.")
+    upload = commands.add_parser(
+        'upload', help="End-to-end upload throughput against a fake Drive.")
+    upload.add_argument("--tree", choices=TREES, default='mixed',
+                        help="Many tiny files (up to 16K), a few huge ones "
+                             "(64M), or a mix (default).")
+    upload.add_argument("--files", type=int,
+                        help="Number of files (default: 1000 tiny, 4 huge, "
+                             "200 mixed).")
+    upload.add_argument("--seed", type=int, default=0,
+                        help="Seed of the file sizes (default 0).")
+    upload.add_argument("--rtt", type=float, default=0.05,
+                        help="Simulated seconds per API call (default "
+                             "0.05).")
+    upload.add_argument("--bandwidth", type=driveuploader.parse_bytes,
+                        help="Simulated upload bandwidth per second, e.g. "
+                             "20M (default: unlimited).")
+    upload.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Uploader --jobs (default 1).")
+    upload.add_argument("--engine", default=driveuploader.SYNC_ENGINE,
+                        choices=(driveuploader.SYNC_ENGINE,
+                                 driveuploader.ASYNC_ENGINE),
+                        help="Uploader --engine (default threads).")
+    upload.add_argument("--order", default=driveuploader.FIFO,
+                        choices=driveuploader.ORDERS,
+                        help="Uploader --order (default fifo).")
+    upload.add_argument("--batch", action='store_true',
+                        help="Uploader --batch.")
+    upload.add_argument("--index_folder", action='store_true',
+                        help="Uploader --index_folder.")
+    upload.add_argument("--chunk-size", type=driveuploader.parse_size,
+                        default=driveuploader.DEFAULT_CHUNK_SIZE,
+                        help="Uploader --chunk-size (default 8M).")
+    upload.add_argument("--json", metavar='PATH',
+                        help="Also write the result to PATH as JSON.")
+    comparison = commands.add_parser(
+        'compare', help="Compare the --json results of two runs.")
+    comparison.add_argument("before")
+    comparison.add_argument("after")
+    args = parser.parse_args()
+
+    if args.command == 'hashing':
+        root = tempfile.mkdtemp(prefix='driveuploader-bench-')
+        try:
+            paths = make_tree(root, [args.size] * args.files)
+            result = bench_hashing(paths, args.workers)
+        finally:
+            shutil.rmtree(root)
+        print_hashing(result)
+    elif args.command == 'upload':
+        if args.files is None:
+            args.files = TREE_FILES[args.tree]
+        root = tempfile.mkdtemp(prefix='driveuploader-bench-')
+        try:
+            paths = make_tree(root, tree_sizes(args.tree, args.files,
+                                               args.seed))
+            result = bench_upload(root, paths, args.rtt, args.bandwidth,
+                                  jobs=args.jobs, engine=args.engine,
+                                  order=args.order, batch=args.batch,
+                                  index_folder=args.index_folder,
+                                  chunk_size=args.chunk_size)
+        finally:
+            shutil.rmtree(root)
+        print_upload(result)
+    elif args.command == 'compare':
+        compare(args.before, args.after)
+        return
+    else:
+        parser.print_help()
+        return
+    if args.json:
+        write_result(args.json, args.command, args, result)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,21 +10,113 @@ metadata, so manually uploaded files must be forced.
 from __future__ import print_function
 
 import argparse
+import collections
+import hashlib
 import httplib2
+import json
+import mmap
 import os
+import random
+import socket
+import sqlite3
+import sys
+import threading
 import time
 
 from apiclient import discovery
-from apiclient.http import MediaFileUpload
+from apiclient.errors import HttpError
+from apiclient.http import BatchHttpRequest, MediaFileUpload
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from oauth2client import client
 from oauth2client import tools
 from oauth2client.file import Storage
 
+try:
+    from os import scandir
+except ImportError:  # Python < 3.5
+    from scandir import scandir
+
 
 SCOPES = 'https://www.googleapis.com/auth/drive'
+API_URL = 'https://www.googleapis.com/'
+DISCOVERY_PATH = 'discovery/v1/apis/{api}/{apiVersion}/rest'
+BATCH_PATH = 'batch/drive/v3'
 CLIENT_SECRET_FILE = 'client_secret.json'
+SESSION_JOURNAL_FILE = 'upload_sessions.json'
+SESSION_LIFETIME = 7 * 24 * 60 * 60  # Drive expires upload sessions in a week
+HASH_CACHE_FILE = 'hash_cache.sqlite3'
+FOLDER_CACHE_FILE = 'folder_cache.json'
+REMOTE_INDEX_FILE = 'drive_index.sqlite3'
+REMOTE_INDEX_TTL = 7 * 24 * 60 * 60  # seconds between full folder listings
+DEFAULT_RETRIES = 5
+DEFAULT_TIMEOUT = 60  # seconds a socket may block
+BACKOFF_BASE = 1.0  # seconds
+BACKOFF_CAP = 64.0
+RATE_LIMIT_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded')
+
+ADAPTIVE_INITIAL = 2  # files in flight when --adaptive starts
+ADAPTIVE_GAIN = 0.05  # throughput gain that counts as rising
+ADAPTIVE_LATENCY_RISE = 1.5  # latency growth that counts as rising
+ADAPTIVE_PROBE_AFTER = 3  # windows without change before trying one more
+
+clock = getattr(time, 'monotonic', time.time)
+# Errors that fail a single file instead of aborting the run: API
+# errors, transport errors such as an unknown host, and file errors.
+FILE_ERRORS = (HttpError, httplib2.HttpLib2Error, IOError, OSError)
+# Errors of a connection that failed or timed out, retried like a 5xx.
+try:
+    TRANSPORT_ERRORS = (socket.timeout, ConnectionError,
+                        httplib2.HttpLib2Error)
+except NameError:  # Python 2
+    TRANSPORT_ERRORS = (socket.timeout, socket.error,
+                        httplib2.HttpLib2Error)
+RETRYABLE_ERRORS = (HttpError,) + TRANSPORT_ERRORS
 APPLICATION_NAME = 'Google Drive API'
 FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+NO_OVERWRITE_PROPERTY = "{ key='no_overwrite' and value='true'}"
+# Prefix of the IDs --check makes up for folders missing in Drive.
+MISSING_FOLDER = 'missing-folder-'
+FILE_FIELDS = "id, name, properties, description"
+CHECKSUM_FIELDS = "md5Checksum, size"
+MIRROR_FIELDS = "id, name, parents, properties, description, md5Checksum, size"
+CHANGE_FIELDS = ("nextPageToken, newStartPageToken, changes(fileId, removed, "
+                 "file(mimeType, trashed, {}))".format(MIRROR_FIELDS))
+HASH_BLOCK_SIZE = 1024 * 1024
+MMAP_THRESHOLD = 64 * 1024 * 1024  # larger files are hashed from an mmap
+PAGE_SIZE = 1000  # largest page files().list will return
+BATCH_SIZE = 100  # most sub-requests a batch request may hold
+QUEUE_PER_JOB = 4  # files queued ahead per worker thread
+LARGE_FILE_SIZE = 64 * 1024 * 1024  # smallest file in the large file lane
+LARGE_LANE_SHARE = 4  # one in this many jobs works the large file lane
+MANIFEST_BLOCK_SIZE = 64 * 1024
+CHUNK_GRANULARITY = 256 * 1024  # resumable chunks must be multiples of this
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+RESUMABLE_THRESHOLD = 5 * 1024 * 1024  # larger files use resumable uploads
+RESUME_INCOMPLETE = 308  # Drive's reply to a chunk that didn't finish
+
+UPLOADED = 'uploaded'
+UPDATED = 'updated'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+CREATE = 'create'
+UPDATE = 'update'
+BACKUP = 'backup'  # flag the Drive file as a backup, then create
+SKIP = 'skip'
+
+SYNC_ENGINE = 'threads'
+ASYNC_ENGINE = 'async'
+
+# Phases of a file timed with --timings, in the order they happen.
+PHASES = ('stat', 'folder', 'lookup', 'hash', 'backup', 'upload', 'update')
+
+# Upper bounds, in seconds, of the --metrics upload latency histogram.
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+FIFO = 'fifo'
+LARGEST_FIRST = 'largest-first'
+SMALLEST_FIRST = 'smallest-first'
+ORDERS = (FIFO, LARGEST_FIRST, SMALLEST_FIRST)
 
 SCRIPT_DIR = os.path.split(os.path.realpath(__file__))[0]
 
@@ -71,8 +163,38 @@ class Uploader(object):
                  no_overwrite=False,
                  description=None,
                  backup=False,
+                 jobs=1,
+                 index_folder=False,
+                 batch=False,
+                 chunk_size=DEFAULT_CHUNK_SIZE,
+                 resumable_threshold=RESUMABLE_THRESHOLD,
+                 checksum=False,
+                 hash_workers=1,
+                 retries=DEFAULT_RETRIES,
+                 rate=None,
+                 burst=None,
+                 adaptive=False,
+                 recursive=False,
+                 from_file=None,
+                 null=False,
+                 folder_cache=False,
+                 remote_index=False,
+                 index_ttl=REMOTE_INDEX_TTL,
+                 plan=None,
+                 order=FIFO,
+                 timeout=DEFAULT_TIMEOUT,
+                 max_per_host=None,
+                 engine=SYNC_ENGINE,
+                 api_url=None,
+                 credentials=None,
+                 timings=False,
+                 trace=None,
+                 metrics=None,
                  **kwargs):
-        self.file_list = kwargs['file_list'].split(',')
+        if from_file:
+            self.file_list = read_manifest(from_file, null)
+        else:
+            self.file_list = kwargs['file_list'].split(',')
         if folder:
             self.drive_folder = folder
         else:
@@ -85,39 +207,501 @@ class Uploader(object):
         self.no_overwrite = no_overwrite
         self.description = description
         self.backup = backup
-        credentials = get_credentials(SCRIPT_DIR)
-        http = credentials.authorize(httplib2.Http())
-        self.service = discovery.build('drive', 'v3', http=http)
+        self.jobs = max(jobs or 1, 1)
+        self.index_folders = index_folder or remote_index
+        self.batch = batch
+        self.chunk_size = chunk_size
+        self.resumable_threshold = resumable_threshold
+        self.checksum = checksum
+        self.hash_workers = max(hash_workers or 1, 1)
+        self._hash_pool = None
+        self.retries = retries
+        self.stats = RunStats()
+        self.timings = timings or bool(trace)
+        self.trace_path = trace
+        self.metrics_path = metrics
+        self.timer = None
+        if rate:
+            self.limiter = TokenBucket(rate, burst or max(int(rate), 1))
+        else:
+            self.limiter = None
+        self.adaptive = adaptive
+        self.controller = None
+        self.recursive = recursive
+        self.plan_path = plan
+        self.order = order
+        self.engine = engine
+        if checksum:
+            self.file_fields = "{}, {}".format(FILE_FIELDS, CHECKSUM_FIELDS)
+        else:
+            self.file_fields = FILE_FIELDS
+        if remote_index:
+            self.mirror_fields = MIRROR_FIELDS
+        else:
+            self.mirror_fields = self.file_fields
+        self.results = []
+        self._folder_ids = {}
+        self._folder_lock = threading.Lock()
+        self._root_id = None
+        self._missing_folders = 0
+        self.dry_run = False
+        if folder_cache:
+            self.folder_cache = FolderCache(
+                os.path.join(SCRIPT_DIR, FOLDER_CACHE_FILE))
+        else:
+            self.folder_cache = None
+        self._folder_index = {}
+        self._index_lock = threading.Lock()
+        self._listing_locks = {}
+        if remote_index:
+            self.remote_index = RemoteIndex(
+                os.path.join(SCRIPT_DIR, REMOTE_INDEX_FILE))
+        else:
+            self.remote_index = None
+        self.index_ttl = index_ttl
+        self.sessions = SessionJournal(
+            os.path.join(SCRIPT_DIR, SESSION_JOURNAL_FILE))
+        if checksum:
+            self.hash_cache = HashCache(
+                os.path.join(SCRIPT_DIR, HASH_CACHE_FILE))
+        else:
+            self.hash_cache = None
+        # api_url and credentials point the Uploader at another server
+        # implementing the Drive API, such as fakedrive.FakeDrive.
+        self.credentials = credentials or get_credentials(SCRIPT_DIR)
+        self.pool = ConnectionPool(self.credentials, timeout,
+                                   max_per_host or self.jobs,
+                                   self.count_connection)
+        if api_url:
+            self.api_url = api_url
+            self.service = discovery.build(
+                'drive', 'v3', http=self.pool.new_http(),
+                discoveryServiceUrl=api_url + DISCOVERY_PATH,
+                cache_discovery=False)
+        else:
+            self.api_url = API_URL
+            self.service = discovery.build('drive', 'v3',
+                                           http=self.pool.new_http())
+
+    def count_connection(self, opened):
+        """Count a request that opened a new connection, or reused a
+        kept-alive one if opened is False.
+
+        :type opened: bool
+        """
+        self.stats.add('connections_opened' if opened else
+                       'connections_reused')
+
+    def execute(self, request, cost=1):
+        """Execute an API request over a pooled connection.
+
+        :type request: apiclient.http.HttpRequest
+        :type cost: int
+        """
+        def call():
+            self.count_call(getattr(request, 'methodId', 'batch'))
+            return self.send(request.execute)
+        return self.retry(call, cost)
+
+    def count_call(self, method_id):
+        """Count an API request sent, by method ID, with timings.
+
+        :type method_id: str
+        """
+        if self.timer:
+            self.timer.count(method_id)
+
+    def phase(self, name, filepath=None):
+        """Return a context manager timing phase name of filepath
+        (None for work shared by several files) with timings, and one
+        doing nothing without.
+
+        :type name: str
+        :type filepath: str | None
+        """
+        if self.timer is None:
+            return NO_PHASE
+        return Phase(self.timer, name, filepath)
+
+    def send(self, method):
+        """Return method(http=http) for an Http object borrowed from
+        the connection pool for the duration of the call. httplib2 is not
+        thread-safe, so an Http object is only ever used by one thread
+        at a time.
+
+        :type method: (httplib2.Http) -> object
+        """
+        http = self.pool.acquire()
+        try:
+            return method(http=http)
+        finally:
+            self.pool.release(http)
 
-    def find_folder(self):
-        """Return the requested folder in Google Drive.
-        If the folder file is not located, create it.
+    def retry(self, call, cost=1):
+        """Return call(), retrying rate limit, server and transport
+        errors up to retries times with capped exponential backoff and
+        jitter. Every attempt first takes cost tokens from the rate
+        limiter.
+
+        :type call: () -> object
+        :type cost: int
+        """
+        attempt = 0
+        while True:
+            self.throttle(cost)
+            try:
+                return call()
+            except RETRYABLE_ERRORS as error:
+                if attempt >= self.retries or not is_retryable(error):
+                    raise
+                self.backoff(attempt, error)
+                attempt += 1
+
+    def throttle(self, cost=1):
+        """Wait until the rate limiter allows cost more requests.
+
+        :type cost: int
+        """
+        wait = self.throttle_delay(cost)
+        if wait:
+            time.sleep(wait)
+
+    def throttle_delay(self, cost=1):
+        """Reserve cost requests from the rate limiter and return the
+        seconds to wait before sending them.
+
+        :type cost: int
+        """
+        if self.limiter is None:
+            return 0
+        wait = self.limiter.reserve(cost)
+        if wait:
+            self.stats.add('throttle_waits')
+            self.stats.add('throttle_seconds', wait)
+        return wait
+
+    def backoff(self, attempt, error, count=1):
+        """Sleep before retry number attempt + 1 of count requests that
+        failed with error.
+
+        :type attempt: int
+        :type error: Exception
+        :type count: int
+        """
+        time.sleep(self.retry_delay(attempt, error, count))
+
+    def retry_delay(self, attempt, error, count=1):
+        """Record and return the delay before retry number attempt + 1
+        of count requests that failed with error. Uses "full jitter": a
+        random delay up to BACKOFF_BASE * 2 ** attempt, capped at
+        BACKOFF_CAP.
+
+        :type attempt: int
+        :type error: Exception
+        :type count: int
+        """
+        delay = random.uniform(0, min(BACKOFF_CAP,
+                                      BACKOFF_BASE * 2 ** attempt))
+        self.stats.add('retries', count)
+        self.stats.add('retry_seconds', delay)
+        if is_rate_limited(error):
+            self.stats.add('drive_throttled', count)
+            if self.controller:
+                self.controller.throttled()
+        print("{}, retrying {} in {:.1f}s.".format(
+            describe_error(error),
+            "{} requests".format(count) if count > 1 else "request", delay))
+        return delay
+
+    def execute_media(self, request, file_class, target):
+        """Execute a create or update request carrying the media of
+        file_class. Resumable uploads are sent chunk by chunk and their
+        session is journaled, so an interrupted upload of the same file
+        to the same target continues from the last committed byte.
+
+        :type request: apiclient.http.HttpRequest
+        :type file_class: LocalFile
+        :type target: str
+        """
+        if request.resumable is None:
+            return self.execute(request)
+        key = file_class.session_key()
+        session = self.sessions.get(key, target)
+        if session:
+            print("Resuming upload of {} from byte {}.".format(
+                file_class.filepath, session['offset']))
+            request.resumable_uri = session['uri']
+            request.resumable_progress = session['offset']
+            file_class.resumed_bytes = session['offset']
+            # In error state next_chunk first asks Drive which bytes it
+            # has committed, and continues from there.
+            request._in_error_state = True
+        response = None
+        while response is None:
+            try:
+                _, response = self.retry(
+                    lambda: self.send_chunk(request))
+            except HttpError as error:
+                if not session or error.resp.status not in (404, 410):
+                    raise
+                print("Upload session of {} expired, starting "
+                      "over.".format(file_class.filepath))
+                session = None
+                request.resumable_uri = None
+                request.resumable_progress = 0
+                request._in_error_state = False
+                file_class.resumed_bytes = 0
+                continue
+            if response is None:
+                self.sessions.save(key, target, request.resumable_uri,
+                                   request.resumable_progress)
+        self.sessions.remove(key)
+        return response
+
+    def send_chunk(self, request):
+        """Send the next chunk of a resumable upload request.
+
+        :type request: apiclient.http.HttpRequest
+        """
+        if request.resumable_uri is None or request._in_error_state:
+            # The first chunk starts the upload session beforehand, and
+            # after an error Drive is first asked which bytes it has.
+            self.count_call(request.methodId)
+        self.count_call(request.methodId)
+        try:
+            return self.send(request.next_chunk)
+        except TRANSPORT_ERRORS:
+            # The chunk may or may not have arrived: have the retry ask
+            # Drive which bytes it has instead of sending them again.
+            if request.resumable_uri is not None:
+                request._in_error_state = True
+            raise
+
+    @property
+    def folder_id(self):
+        """ID of the target Drive folder, resolved once per run."""
+        return self.find_folder()
+
+    def find_folder(self, folder_name=None):
+        """Return the ID of the requested folder in Google Drive.
+        If the folder file is not located, create it. Every folder is
+        resolved only once per Uploader; later calls use the cached ID.
+
+        A path such as 'a/b/c' is resolved from the My Drive root one
+        folder at a time, creating the folders that are missing. A
+        single name is searched for in the whole Drive.
+
+        :type folder_name: str | None
+        """
+        if folder_name is None:
+            folder_name = self.drive_folder
+        key = folder_key(folder_name)
+        if not key:
+            return "root"
+        if key.startswith('/'):
+            return self.resolve_path(key, 'root', '')
+        # Hold the lock across the lookup so concurrent workers can't
+        # each create their own copy of a missing folder.
+        with self._folder_lock:
+            if key not in self._folder_ids:
+                self._folder_ids[key] = (self.cached_folder(key) or
+                                         self._find_folder(key))
+                self.save_folder(key, self._folder_ids[key])
+            return self._folder_ids[key]
+
+    def _find_folder(self, folder_name):
+        """Query Google Drive for folder_name, creating it if missing.
+
+        :type folder_name: str
         """
-        if self.drive_folder == "root":
-            return self.drive_folder
         folder = self.service.files().list(
             q="mimeType='{}' and name='{}' "
               "and trashed=false".format(FOLDER_MIMETYPE,
-                                         self.drive_folder),
-            spaces='drive').execute()['files']
+                                         escape_query(folder_name)),
+            spaces='drive')
+        folder = self.execute(folder)['files']
         if not folder:
-            return self.make_folder(self.drive_folder)['id']
+            return self.make_folder(folder_name)['id']
         else:
             return folder[0]['id']
 
-    def make_folder(self, folder_name):
-        """Create Google Drive folder.
+    def resolve_folder(self, drive_dir):
+        """Return the ID of drive_dir, a '/' separated path below the
+        target folder, creating the folders that are missing. Each
+        folder is resolved or created once per run.
+
+        :type drive_dir: str
+        """
+        if not drive_dir:
+            return self.folder_id
+        return self.resolve_path(drive_dir, self.folder_id,
+                                 folder_key(self.drive_folder))
+
+    def resolve_path(self, path, parent_id, parent_key):
+        """Return the ID of the folder path below the folder parent_id,
+        whose cache key is parent_key, creating missing folders. Every
+        resolved prefix is cached by its key; a path already in the
+        folder cache costs a single lookup, which checks that its last
+        folder is still in the cached parent.
+
+        :type path: str
+        :type parent_id: str
+        :type parent_key: str
+        """
+        names = [name for name in path.split('/') if name]
+        full_key = '/'.join([parent_key] + names)
+        with self._folder_lock:
+            folder_id = self._folder_ids.get(full_key)
+            if folder_id is None:
+                if len(names) == 1:
+                    cached_parent = parent_id
+                else:
+                    cached_parent = self.known_folder(
+                        full_key.rsplit('/', 1)[0])
+                if cached_parent is not None:
+                    folder_id = self.cached_folder(full_key, cached_parent)
+                if folder_id is not None:
+                    self._folder_ids[full_key] = folder_id
+            if folder_id is not None:
+                return folder_id
+            key = parent_key
+            for name in names:
+                key = key + '/' + name
+                folder_id = self._folder_ids.get(key)
+                if folder_id is None:
+                    folder_id = (self.cached_folder(key, parent_id) or
+                                 self.find_child_folder(name, parent_id))
+                    self._folder_ids[key] = folder_id
+                    self.save_folder(key, folder_id)
+                parent_id = folder_id
+            return parent_id
+
+    def cached_folder(self, key, parent_id=None):
+        """Return the folder ID the persistent folder cache has for key,
+        if the folder still exists under that name, is not trashed and,
+        if parent_id is given, is still in the folder parent_id. Stale
+        entries are dropped.
+
+        :type key: str
+        :type parent_id: str | None
+        """
+        if self.folder_cache is None:
+            return None
+        folder_id = self.folder_cache.get(key)
+        if folder_id is None:
+            return None
+        try:
+            folder = self.execute(self.service.files().get(
+                fileId=folder_id, fields="id, name, trashed, parents"))
+        except HttpError as error:
+            if int(error.resp.status) != 404:
+                raise
+            folder = None
+        if parent_id == 'root':
+            parent_id = self.root_id
+        if (folder and not folder.get('trashed') and
+                folder.get('name') == key.rsplit('/', 1)[-1] and
+                (parent_id is None or
+                 parent_id in folder.get('parents', ()))):
+            return folder_id
+        self.folder_cache.remove(key)
+        return None
+
+    def known_folder(self, key):
+        """Return the folder ID resolved in this run or cached for key,
+        without checking it, or None.
+
+        :type key: str
+        """
+        folder_id = self._folder_ids.get(key)
+        if folder_id is None and self.folder_cache is not None:
+            folder_id = self.folder_cache.get(key)
+        return folder_id
+
+    @property
+    def root_id(self):
+        """ID of the My Drive root folder, which Drive lists as the
+        parent of its folders in place of 'root'. Looked up once per
+        Uploader.
+        """
+        if self._root_id is None:
+            self._root_id = self.execute(self.service.files().get(
+                fileId='root', fields="id"))['id']
+        return self._root_id
+
+    def save_folder(self, key, folder_id):
+        """Record a resolved folder in the persistent folder cache.
+
+        :type key: str
+        :type folder_id: str
+        """
+        if self.folder_cache is not None and not is_missing(folder_id):
+            self.folder_cache.put(key, folder_id)
+
+    def forget_missing_folders(self):
+        """Drop the made up IDs of the folders check found missing, so
+        a later upload looks them up again and creates them.
+        """
+        with self._folder_lock:
+            for key, folder_id in list(self._folder_ids.items()):
+                if is_missing(folder_id):
+                    del self._folder_ids[key]
+        with self._index_lock:
+            for folder_id in list(self._folder_index):
+                if is_missing(folder_id):
+                    del self._folder_index[folder_id]
+
+    def find_child_folder(self, folder_name, parent_id):
+        """Return the ID of the folder folder_name in parent_id,
+        creating it if it doesn't exist.
+
+        :type folder_name: str
+        :type parent_id: str
+        """
+        if is_missing(parent_id):
+            return self.make_folder(folder_name, parent_id)['id']
+        folders = self.execute(self.service.files().list(
+            q="'{}' in parents and mimeType='{}' and name='{}' "
+              "and trashed=false".format(parent_id, FOLDER_MIMETYPE,
+                                         escape_query(folder_name)),
+            fields="files(id)"))['files']
+        if folders:
+            return folders[0]['id']
+        return self.make_folder(folder_name, parent_id)['id']
+
+    def make_folder(self, folder_name, parent_id=None):
+        """Create Google Drive folder. With dry_run nothing is created
+        and the folder gets a made up ID (see is_missing) and an empty
+        folder index.
 
         :type folder_name: str
+        :type parent_id: str | None
         """
+        if self.dry_run:
+            # Called with _folder_lock held, like every folder lookup.
+            self._missing_folders += 1
+            folder_id = MISSING_FOLDER + str(self._missing_folders)
+            print('{} folder is not in GDrive, it would be '
+                  'created.'.format(folder_name))
+            with self._index_lock:
+                self._folder_index[folder_id] = {}
+            return {'file': None, 'id': folder_id}
         file_metadata = {
             'name': folder_name,
             'mimeType': FOLDER_MIMETYPE
         }
-        folder = self.service.files().create(
-            body=file_metadata).execute()
+        if parent_id:
+            file_metadata['parents'] = [parent_id]
+        folder = self.execute(self.service.files().create(
+            body=file_metadata))
         print('{} folder created, ID: {}'.format(folder_name,
                                                  folder.get('id')))
+        if self.index_folders:
+            # A new folder is empty, there is nothing to list.
+            with self._index_lock:
+                self._folder_index[folder.get('id')] = {}
+            if self.remote_index:
+                self.remote_index.replace_folder(folder.get('id'), [])
         return {'file': folder, 'id': folder.get('id')}
 
     def find_drive_files(self, filename, folder_id):
@@ -125,210 +709,2505 @@ class Uploader(object):
         parent folder. Return empty list if none are found. Currently
         only the first file is used.
 
+        In index_folder mode the lookup is served from the folder index
+        instead of a files().list query per file, and with remote_index
+        from the local mirror of the folder.
+
         :type filename: str
         :type folder_id: str
         """
-        no_overwrite_property = "{ key='no_overwrite' and value='true'}"
-        files = self.service.files().list(
+        if self.index_folders:
+            return self.index_folder(folder_id).get(filename)
+        files = self.execute(self.find_request(filename, folder_id))['files']
+        return files[0] if files else None
+
+    def find_request(self, filename, folder_id):
+        """Return the files().list request used by find_drive_files.
+
+        :type filename: str
+        :type folder_id: str
+        """
+        return self.service.files().list(
             q="'{}' in parents and name='{}' and trashed=false and not "
               "mimeType='{}' and not properties has {}".format(
-                folder_id, filename, FOLDER_MIMETYPE, no_overwrite_property),
-            fields="files(id, name, properties, "
-                   "description)").execute()['files']
-        return files[0] if files else None
+                folder_id, escape_query(filename), FOLDER_MIMETYPE,
+                NO_OVERWRITE_PROPERTY),
+            fields="files({})".format(self.file_fields))
+
+    def index_folder(self, folder_id):
+        """Return a dict of file name to file metadata for every
+        file find_drive_files could match in folder_id. The folder is
+        listed once per run and the index is reused afterwards.
+
+        Different folders are listed in parallel; a worker wanting a
+        folder that is being listed waits for that listing only.
+
+        :type folder_id: str
+        """
+        with self._index_lock:
+            index = self._folder_index.get(folder_id)
+            if index is not None:
+                return index
+            listing_lock = self._listing_locks.setdefault(folder_id,
+                                                          threading.Lock())
+        with listing_lock:
+            with self._index_lock:
+                index = self._folder_index.get(folder_id)
+            if index is None:
+                index = self.list_folder(folder_id)
+                with self._index_lock:
+                    index = self._folder_index.setdefault(folder_id, index)
+            return index
+
+    def list_folder(self, folder_id):
+        """Page through folder_id and return a dict of file name to
+        file metadata. Like find_drive_files, the first file found
+        with a name wins.
+
+        With remote_index the folder is read from the local mirror, and
+        only listed from Drive when the mirror does not hold it or its
+        last full listing is older than index_ttl seconds.
+
+        :type folder_id: str
+        """
+        if self.remote_index:
+            return self.mirror_folder(folder_id)
+        index = {}
+        for drive_file in self.page_folder(
+                folder_id, self.file_fields,
+                "not properties has {}".format(NO_OVERWRITE_PROPERTY)):
+            index.setdefault(drive_file['name'], drive_file)
+        return index
+
+    def mirror_folder(self, folder_id):
+        """Return the index of folder_id built from the remote index,
+        refreshing the mirrored folder from Drive first if it is missing
+        or older than index_ttl. Files flagged no_overwrite are mirrored
+        but left out of the index, as find_drive_files never matches
+        them.
+
+        :type folder_id: str
+        """
+        listed_at = self.remote_index.listed_at(folder_id)
+        # Between listings the folder is kept current by
+        # refresh_remote_index, index_ttl only bounds any drift.
+        if listed_at is None or time.time() - listed_at > self.index_ttl:
+            self.remote_index.replace_folder(
+                folder_id, list(self.page_folder(folder_id, MIRROR_FIELDS)))
+        index = {}
+        for drive_file in self.remote_index.files(folder_id):
+            if drive_file['properties'].get('no_overwrite') != 'true':
+                index.setdefault(drive_file['name'], drive_file)
+        return index
+
+    def refresh_remote_index(self):
+        """Bring the remote index up to date with what changed in Drive
+        since the last run, read from the changes feed one page at a
+        time. Without a stored cursor, or when Drive no longer accepts
+        it, a new cursor is taken and the mirrored folders are listed
+        again when next needed.
+        """
+        page_token = self.remote_index.page_token()
+        if page_token is None:
+            self.restart_changes()
+            return
+        while True:
+            try:
+                response = self.execute(self.service.changes().list(
+                    pageToken=page_token,
+                    pageSize=PAGE_SIZE,
+                    spaces='drive',
+                    fields=CHANGE_FIELDS))
+            except HttpError as error:
+                if error.resp.status not in (400, 404, 410):
+                    raise
+                print("Drive changes cursor is no longer valid, the "
+                      "remote index will be rebuilt.")
+                self.restart_changes()
+                return
+            page_token = (response.get('nextPageToken') or
+                          response['newStartPageToken'])
+            self.stats.add('changes', len(response['changes']))
+            self.remote_index.apply_changes(response['changes'], page_token)
+            if 'newStartPageToken' in response:
+                return
+
+    def restart_changes(self):
+        """Empty the remote index and start following the changes feed
+        from now on.
+        """
+        response = self.execute(self.service.changes().getStartPageToken())
+        self.remote_index.reset(response['startPageToken'])
+
+    def page_folder(self, folder_id, fields, query=None):
+        """Yield the metadata of the files (not folders) in folder_id,
+        PAGE_SIZE per files().list request.
+
+        :type folder_id: str
+        :type fields: str
+        :type query: str | None
+        """
+        q = "'{}' in parents and trashed=false and not mimeType='{}'".format(
+            folder_id, FOLDER_MIMETYPE)
+        if query:
+            q = "{} and {}".format(q, query)
+        page_token = None
+        while True:
+            response = self.execute(self.service.files().list(
+                q=q,
+                pageSize=PAGE_SIZE,
+                pageToken=page_token,
+                fields="nextPageToken, files({})".format(fields)))
+            for drive_file in response['files']:
+                yield drive_file
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return
+
+    def _update_index(self, folder_id, filename, drive_file):
+        """Keep an already built folder index in line with a change
+        made by this run. drive_file None removes the entry.
+
+        :type folder_id: str
+        :type filename: str
+        :type drive_file: dict | None
+        """
+        with self._index_lock:
+            index = self._folder_index.get(folder_id)
+            if index is None:
+                return
+            if drive_file is None:
+                index.pop(filename, None)
+            else:
+                index.setdefault(filename, drive_file)
 
     def upload(self, force=False, check=False):
         """Upload files to GDrive. Only overwrite existing files if
         they were more recently modified, or if force == True.
 
+        Every file is first planned (see decide) and the PlanAction is
+        then carried out by execute_action. With check nothing is
+        carried out: the plan is computed from folder listings, printed
+        and, with plan_path, written out as JSON. With plan_path and
+        without check, the whole plan is written before any file is
+        uploaded.
+
+        With more than one job, files are processed by a pool of worker
+        threads. Unless order is FIFO, the whole plan is made first and
+        files are uploaded in size order (see schedule). Results are
+        returned (and printed) in file_list order.
+
         :type force: bool
         :type check: bool
         """
-        for local_file in self.file_list:
-            file_class = LocalFile(local_file, self.home_dir)
-            if self.description:
-                file_class.file_metadata['description'] = self.description
-            media = MediaFileUpload(file_class.filepath,
-                                    mimetype=self.mimetype)
+        self.stats = RunStats()
+        if self.timings or self.metrics_path:
+            self.timer = PhaseTimer()
+        if self.remote_index:
+            with self.phase('lookup'):
+                self.refresh_remote_index()
+        if check:
+            return self.check(force)
+        with self.phase('folder'):
             folder_id = self.find_folder()
-            file_found = self.find_drive_files(file_class.filename, folder_id)
-            file_class.set_upload_properties(force, check, file_found, media, folder_id)
-            if file_found and not self.no_overwrite:
-                self.update_file(file_class)
-                continue
-            if self.backup:
-                print("File {} not found for "
-                      "backup.".format(file_class.filename))
-            self.upload_file(file_class)
-    
-    def update_file(self, file_class):
-        if not file_class.force:
-            try:
-                modified = int(file_class.file_found['properties']['modified'])
-            except KeyError:
-                print("Properties not defined for {}.".format(
-                    file_class.filename))
-                print_not_uploaded(file_class, None)
-                return
-            if modified > file_class.file_last_update:
-                print("File {} was last modified after local file.".format(
-                    file_class.filename))
-                print_not_uploaded(file_class, modified)
-                return
-            elif modified == file_class.file_last_update:
-                print("File {} has same last modified date.".format(
-                    file_class.filename))
-                print_not_uploaded(file_class, modified)
-                return
+        if self.index_folders:
+            with self.phase('lookup'):
+                self.index_folder(folder_id)
+        self.start_hashing()
+        try:
+            if (self.plan_path or self.order != FIFO or
+                    self.engine == ASYNC_ENGINE):
+                actions = list(self.plan(force))
+                if self.plan_path:
+                    write_plan(self.plan_path, actions)
+            elif self.batch:
+                actions = self.plan(force)
+            else:
+                actions = None
+            if self.engine == ASYNC_ENGINE:
+                # Imported here: the async engine needs Python 3 and
+                # aiohttp, which the thread engine does not.
+                from asyncengine import AsyncEngine
+                results = AsyncEngine(self).run(actions)
+            else:
+                results = self.run_threads(actions, force)
+        finally:
+            self.controller = None
+            self.stop_hashing()
+        self.results = results
+        print_results(results)
+        print_stats(self.stats)
+        self.report_run(results)
+        return results
 
-        if file_class.check:
-            print("File {} is ready to upload.".format(file_class.filename))
-            print(parse_check(file_class.file_last_update, modified, file_class.filename))
-            return
-        if self.backup:
-            self.service.files().update(
-                fileId=file_class.file_found['id'],
-                body={
-                    'name': file_class.filename,
-                    'properties': {'no_overwrite': 'true'}
-                }
-            ).execute()
-            self.upload_file(file_class)
-            return
-        self.service.files().update(
-            fileId=file_class.file_found['id'],
-            media_body=file_class.media,
-            body=file_class.file_metadata
-        ).execute()
-        print("File {} updated.\n".format(file_class.filepath))
-        return
-        
-    def upload_file(self, file_class):
-        if file_class.check:
-            print("File {} does not exist in GDrive. Ready to "
-                  "upload.".format(file_class.filename))
-            print(parse_check(file_class.file_last_update, None, file_class.filename))
+    def report_run(self, results):
+        """Print the timings table, and write the trace and the
+        metrics, if asked for.
+
+        :type results: list[FileResult]
+        """
+        if self.timer is None:
             return
+        self.timer.stop()
+        if self.timings:
+            print_timings(self.timer)
+        if self.trace_path:
+            write_trace(self.trace_path, results, self.timer)
+        if self.metrics_path:
+            write_metrics(self.metrics_path, results, self.stats, self.timer)
+
+    def run_threads(self, actions, force=False):
+        """Carry out actions, or plan and carry out every file if
+        actions is None, on jobs worker threads. Return the FileResults
+        in file_list order.
+
+        :type actions: collections.Iterable[PlanAction] | None
+        :type force: bool
+        """
+        if actions is None:
+            # Plan each file in the worker that uploads it, so per-file
+            # lookups run in parallel too.
+            work = self.iter_files()
+            process = lambda entry: self.execute_action(
+                self.plan_file(entry[0], force, entry[1]))
+        else:
+            if self.batch:
+                work = self.backup_batches(actions)
+            else:
+                work = ((action, False) for action in actions)
+            process = lambda item: self.execute_action(*item)
+        if self.adaptive and self.jobs > 1:
+            self.controller = ConcurrencyController(self.jobs)
+            process = self.controller.wrap(process)
+        if self.order != FIFO:
+            return self.schedule(process, list(work))
+        if self.jobs > 1:
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                return list(ordered_map(executor, process, work,
+                                        self.jobs * QUEUE_PER_JOB))
+        return [process(item) for item in work]
+
+    def schedule(self, process, work):
+        """Return process applied to every (action, backed_up) item of
+        work, in work order, running the items in the size order of
+        self.order. Files of LARGE_FILE_SIZE or more go to a large file
+        lane worked by one in LARGE_LANE_SHARE jobs, the rest to a small
+        file lane worked by the other jobs; a worker whose lane is empty
+        helps the other lane, so no job idles while files are left.
+
+        :type process: ((PlanAction, bool)) -> FileResult
+        :type work: list[(PlanAction, bool)]
+        """
+        sizes = [transfer_size(action) for action, _ in work]
+        order = sorted(range(len(work)), key=sizes.__getitem__,
+                       reverse=self.order == LARGEST_FIRST)
+        if self.jobs == 1:
+            results = [None] * len(work)
+            for index in order:
+                results[index] = process(work[index])
+            return results
+        large = [index for index in order if sizes[index] >= LARGE_FILE_SIZE]
+        small = [index for index in order if sizes[index] < LARGE_FILE_SIZE]
+        if small:
+            large_jobs = min(len(large),
+                             max(self.jobs // LARGE_LANE_SHARE, 1))
+        else:
+            large_jobs = self.jobs
+        return lane_map(lambda index: process(work[index]), [large, small],
+                        [large_jobs, self.jobs - large_jobs])
+
+    def check(self, force=False):
+        """Plan every file without changing anything in Drive, print
+        the plan and return a FileResult per file: skipped, or failed if
+        the file could not be planned. Files are looked up in folder
+        listings, never with a request per file. Folders missing in
+        Drive are not created; their files are planned as new files.
+
+        :type force: bool
+        """
+        self.dry_run = True
+        try:
+            with self.phase('folder'):
+                folder_id = self.find_folder()
+            with self.phase('lookup'):
+                self.index_folder(folder_id)
+            self.start_hashing()
+            try:
+                actions = list(self.plan(force, bulk=True))
+            finally:
+                self.stop_hashing()
+        finally:
+            self.dry_run = False
+            self.forget_missing_folders()
+        if self.plan_path:
+            write_plan(self.plan_path, actions)
+        print_plan(actions)
+        print_stats(self.stats)
+        self.results = [
+            FileResult(action.filepath, FAILED, action.reason)
+            if action.action == FAILED else
+            FileResult(action.filepath, SKIPPED, None)
+            for action in actions]
+        self.report_run(self.results)
+        return self.results
+
+    def start_hashing(self):
+        """Start the hashing process pool if hash_workers asks for one."""
+        if self.checksum and self.hash_workers > 1:
+            self._hash_pool = ProcessPoolExecutor(
+                max_workers=self.hash_workers)
+
+    def stop_hashing(self):
+        """Shut the hashing process pool down and tidy the hash cache."""
+        if self._hash_pool:
+            self._hash_pool.shutdown()
+            self._hash_pool = None
+        if self.hash_cache:
+            self.hash_cache.evict_missing()
+
+    def plan_file(self, local_file, force=False, drive_dir=''):
+        """Look a single file from file_list up in Drive and return its
+        PlanAction. API and file system errors give a failed action
+        instead of aborting the remaining files.
+
+        :type local_file: str
+        :type force: bool
+        :type drive_dir: str
+        """
+        try:
+            file_class = self.prepare_file(local_file, drive_dir)
+            with self.phase('lookup', local_file):
+                file_class.file_found = self.find_drive_files(
+                    file_class.filename, file_class.folder_id)
+        except FILE_ERRORS as error:
+            return failed_action(local_file, error)
+        self.hash_files([file_class])
+        return self.decide(file_class, force)
+
+    def plan(self, force=False, bulk=False):
+        """Yield the PlanAction of every file from iter_files, in order.
+
+        Files are planned BATCH_SIZE at a time. They are looked up in
+        the folder index with index_folders or bulk, with one batch
+        request per BATCH_SIZE files with batch, and otherwise with a
+        files().list request each.
+
+        :type force: bool
+        :type bulk: bool
+        """
+        bulk = bulk or self.index_folders
+        for chunk in chunks(self.iter_files(), BATCH_SIZE):
+            items = []
+            for local_file, drive_dir in chunk:
+                try:
+                    items.append(self.prepare_file(local_file, drive_dir))
+                except FILE_ERRORS as error:
+                    items.append(failed_action(local_file, error))
+            file_classes = [item for item in items
+                            if isinstance(item, LocalFile)]
+            if bulk:
+                # A folder that can't be listed fails its files only,
+                # and is not listed again for each of them.
+                errors = {}
+                for file_class in file_classes:
+                    folder_id = file_class.folder_id
+                    if folder_id in errors:
+                        file_class.error = errors[folder_id]
+                        continue
+                    try:
+                        with self.phase('lookup', file_class.filepath):
+                            file_class.file_found = self.index_folder(
+                                folder_id).get(file_class.filename)
+                    except FILE_ERRORS as error:
+                        file_class.error = errors[folder_id] = error
+            elif not self.batch:
+                for file_class in file_classes:
+                    try:
+                        with self.phase('lookup', file_class.filepath):
+                            file_class.file_found = self.find_drive_files(
+                                file_class.filename, file_class.folder_id)
+                    except FILE_ERRORS as error:
+                        file_class.error = error
+            else:
+                with self.phase('lookup'):
+                    lookups = self.execute_batch(
+                        [self.find_request(file_class.filename,
+                                           file_class.folder_id)
+                         for file_class in file_classes])
+                for file_class, (response, error) in zip(file_classes,
+                                                         lookups):
+                    if error is not None:
+                        file_class.error = error
+                    elif response['files']:
+                        file_class.file_found = response['files'][0]
+            self.hash_files([file_class for file_class in file_classes
+                             if file_class.error is None])
+            for item in items:
+                if isinstance(item, LocalFile):
+                    item = self.decide(item, force)
+                yield item
+
+    def decide(self, file_class, force=False):
+        """Return the PlanAction for a looked up LocalFile: create it
+        if it is not in Drive (or with no_overwrite), otherwise update
+        it, or with backup rename the Drive file and create a new one,
+        if compare says so, and skip it if not.
+
+        :type file_class: LocalFile
+        :type force: bool
+        """
+        if file_class.error is not None:
+            return failed_action(file_class.filepath, file_class.error)
+        if is_missing(file_class.folder_id):
+            return self.make_action(file_class, CREATE,
+                                    "folder not in Drive, would be created")
+        if not file_class.file_found:
+            if self.backup:
+                return self.make_action(file_class, CREATE,
+                                        "not in Drive, nothing to back up")
+            return self.make_action(file_class, CREATE, "not in Drive")
         if self.no_overwrite:
-            file_class.file_metadata['properties']['no_overwrite'] = 'true'
-        file_class.file_metadata['parents'] = [ file_class.folder_id ]
-        self.service.files().create(
-            body=file_class.file_metadata,
-            media_body=file_class.media).execute()
-        print("File {} uploaded.\n".format(file_class.filepath))
+            return self.make_action(file_class, CREATE,
+                                    "no_overwrite, the Drive file is kept")
+        action, reason = self.compare(file_class, force)
+        if action == UPDATE and self.backup:
+            action = BACKUP
+        return self.make_action(file_class, action, reason)
 
+    def make_action(self, file_class, action, reason):
+        """Return the PlanAction of file_class.
 
-class LocalFile(object):
-    def __init__(self, local_file, home_dir):
-        self.filename = os.path.split(local_file)[-1]
-        if home_dir:
-            self.filepath = os.path.join(home_dir, local_file)
+        :type file_class: LocalFile
+        :type action: str
+        :type reason: str
+        """
+        drive_file = file_class.file_found
+        if action == CREATE or not drive_file:
+            file_id = drive_update = None
         else:
-            self.filepath = local_file
-        self.file_last_update = int(os.path.getmtime(self.filepath))
-        self.file_metadata = {
-            'name': self.filename,
-            'properties': {'modified': self.file_last_update}
-        }
-    
-    def set_upload_properties(self, force, check, file_found, media, folder_id):
-        self.force = force
-        self.check = check
-        self.file_found = file_found
-        self.media = media
-        self.folder_id = folder_id
+            file_id = drive_file['id']
+            drive_update = drive_modified(drive_file)
+        return PlanAction(file_class.filepath, action, reason,
+                          file_class.folder_id, file_id, file_class.size,
+                          file_class.file_last_update, drive_update)
 
+    def compare(self, file_class, force=False):
+        """Return (UPDATE, reason) if the Drive file found for
+        file_class is older than the local file or force is set, and
+        (SKIP, reason) if not.
 
-def parse_check(local_update, drive_update, filename):
-    """Parse strings for printing information for 'check' option.
+        With checksum, a Drive file with the same content is never
+        overwritten, even with force.
 
-    :type local_update: int
-    :type drive_update: int | None
-    :type filename: str
-    """
-    time_string = "%Y-%m-%d, %H:%M:%S"
-    local_mod_time = time.strftime(time_string,
-                                   time.localtime(local_update))
-    if drive_update:
-        drive_mod_time = time.strftime(time_string,
-                                       time.localtime(drive_update))
-    else:
-        drive_mod_time = "Undefined"
-    return ("{}:\n  Local file last updated: {}\n  Remote file last updated: "
-        "{}\n").format(filename, local_mod_time, drive_mod_time)
+        :type file_class: LocalFile
+        :type force: bool
+        """
+        if self.checksum and self.same_content(file_class):
+            return SKIP, "contents are unchanged"
+        if force:
+            return UPDATE, "forced"
+        modified = drive_modified(file_class.file_found)
+        if modified is None:
+            return SKIP, "no modified property in Drive, force required"
+        if modified > file_class.file_last_update:
+            return SKIP, "modified in Drive after the local file"
+        if modified == file_class.file_last_update:
+            return SKIP, "same last modified date"
+        return UPDATE, "local file is newer"
 
-def print_not_uploaded(local_file, drive_update):
-    print('FILE WAS NOT UPLOADED!!! Force upload required.')
-    if local_file.check:
-        print(parse_check(local_file.file_last_update, drive_update,
-                          local_file.filename))
-    else:
-        print()
+    def iter_files(self):
+        """Yield (path, drive_dir) for every file to upload, where
+        drive_dir is the folder path below the target folder to upload
+        it to. With recursive, directories in file_list are walked
+        lazily and mirrored as Drive folders.
+        """
+        for local_file in self.file_list:
+            if self.home_dir:
+                local_file = os.path.join(self.home_dir, local_file)
+            if self.recursive and os.path.isdir(local_file):
+                for entry in walk_files(local_file):
+                    yield entry
+            else:
+                yield local_file, ''
 
-def main(check=False, force=False, **kwargs):
-    gdrive = Uploader(**kwargs)
-    if check:
-        gdrive.upload(check=True)
-    elif force:
-        gdrive.upload(force=True)
-    else:
-        gdrive.upload()
+    def prepare_file(self, local_file, drive_dir=''):
+        """Return the LocalFile for a path from iter_files, with the ID
+        of the folder it goes to.
 
+        :type local_file: str
+        :type drive_dir: str
+        """
+        with self.phase('stat', local_file):
+            file_class = LocalFile(local_file, None)
+        if self.description:
+            file_class.file_metadata['description'] = self.description
+        with self.phase('folder', local_file):
+            file_class.folder_id = self.resolve_folder(drive_dir)
+        return file_class
 
-if __name__ == '__main__':
+    def execute_batch(self, requests):
+        """Execute requests as batch requests of up to BATCH_SIZE and
+        return a (response, error) tuple for each, in order. Requests
+        failing with a retryable error, alone or with their whole batch,
+        are retried in a new batch after a backoff, up to retries times.
 
-    arg_help = [
-        "Save or overwrite files to Google Drive. The last modified date of "
-            "the file is written to a custom property, and will only overwrite"
-            " without --force if this date is before the file's last modified "
-            "date.",
-        "Files list separated by comma (no spaces, use quotes). (required).",
-        "Home directory to look for items in file_list. Will use home "
-            "directory instead of current working directory.",
-        "Folder name to upload files to in Google Drive. If omitted, files "
-            "will be placed in root directory.",
-        "Force overwrite.",
-        "Prints last modified dates and whether 'force' is required to "
-            "upload.",
-        "Set the mimetype for all files to be uploaded. Generally, Google "
-            "Drive handles this automatically. Use 'text/plain' to force a "
-            "file to work with Drive editors like Drive Notepad.",
-        "Set a description to all files to be uploaded, visible in GDrive "
-            "app (use quotes). Use --description=\" \" to remove description.",
-        "Add files without overwriting. 'no_overwrite' files will be flagged "
-            "with a custom property and will never be found by the script.",
-        "Enable the 'Press enter to close.' prompt at script end.",
-        "Keep the old file instead of overwriting."
-    ]
+        :type requests: list[apiclient.http.HttpRequest]
+        """
+        responses = [None] * len(requests)
 
-    parent = tools.argparser
-    group = parent.add_argument_group('standard')
-    exclusive_group = parent.add_mutually_exclusive_group()
-    parent.add_argument("file_list", help=arg_help[1])
-    parent.add_argument("-d", "--home_dir", help=arg_help[2])
-    parent.add_argument("--folder", help=arg_help[3])
-    exclusive_group.add_argument("--force",
-                                 help=arg_help[4],
-                                 action='store_true')
-    exclusive_group.add_argument("-c",
-                                 "--check",
-                                 help=arg_help[5],
-                                 action='store_true')
-    parent.add_argument("--mimetype", help=arg_help[6])
-    parent.add_argument("--description", help=arg_help[7])
-    exclusive_group.add_argument("--no_overwrite",
-                        help=arg_help[8],
-                        action='store_true')
-    parent.add_argument("--prompt",
+        def callback(request_id, response, exception):
+            responses[int(request_id)] = (response, exception)
+
+        pending = list(range(len(requests)))
+        attempt = 0
+        while True:
+            for start in range(0, len(pending), BATCH_SIZE):
+                group = pending[start:start + BATCH_SIZE]
+                batch = BatchHttpRequest(callback=callback,
+                                         batch_uri=self.api_url + BATCH_PATH)
+                for index in group:
+                    responses[index] = None
+                    batch.add(requests[index], request_id=str(index))
+                    self.count_call(requests[index].methodId)
+                # Sent once: retries are up to the loop, which resends
+                # only the requests that failed.
+                self.throttle(len(group))
+                self.count_call('batch')
+                try:
+                    self.send(batch.execute)
+                except RETRYABLE_ERRORS as error:
+                    for index in group:
+                        responses[index] = responses[index] or (None, error)
+            pending = [index for index in pending
+                       if responses[index][1] is not None and
+                       is_retryable(responses[index][1])]
+            if not pending or attempt >= self.retries:
+                return responses
+            self.backoff(attempt, responses[pending[0]][1], len(pending))
+            attempt += 1
+
+    def execute_action(self, action, backed_up=False):
+        """Carry out a PlanAction and return its FileResult. API and
+        file system errors are reported as a failed result instead of
+        aborting the remaining files. backed_up is True for a backup
+        whose Drive file was already renamed by backup_batches.
+
+        :type action: PlanAction
+        :type backed_up: bool
+        """
+        result = settled_result(action)
+        if result is not None:
+            return result
+        try:
+            file_class = self.load_file(action)
+            if action.action == UPDATE:
+                with self.phase('update', action.filepath):
+                    status = self.update_file(file_class)
+            else:
+                if action.action == BACKUP and not backed_up:
+                    with self.phase('backup', action.filepath):
+                        self.backup_file(file_class)
+                with self.phase('upload', action.filepath):
+                    status = self.upload_file(file_class)
+        except FILE_ERRORS as error:
+            return failed_result(action.filepath, error)
+        return FileResult(action.filepath, status, None,
+                          file_class.size - file_class.resumed_bytes)
+
+    def load_file(self, action):
+        """Return the LocalFile to upload for action.
+
+        :type action: PlanAction
+        """
+        file_class = LocalFile(action.filepath, None)
+        if self.description:
+            file_class.file_metadata['description'] = self.description
+        file_class.folder_id = action.folder_id
+        if action.file_id:
+            file_class.file_found = {'id': action.file_id}
+        return file_class
+
+    def backup_batches(self, actions):
+        """Yield (action, backed_up) for every PlanAction in actions.
+        The backup renames of BATCH_SIZE actions at a time are sent as
+        one batch request; backed_up is True for the files whose Drive
+        file is already out of the way, so only the new file is created.
+
+        :type actions: collections.Iterable[PlanAction]
+        """
+        for chunk in chunks(actions, BATCH_SIZE):
+            renames = [action for action in chunk if action.action == BACKUP]
+            with self.phase('backup'):
+                backups = self.execute_batch(
+                    [self.backup_request(action.file_id,
+                                         os.path.basename(action.filepath))
+                     for action in renames])
+            errors = {}
+            for action, (_, error) in zip(renames, backups):
+                filename = os.path.basename(action.filepath)
+                if error is None:
+                    self.mark_backed_up(action.file_id, action.folder_id,
+                                        filename)
+                elif self.is_stale(error):
+                    self.drop_stale(action.file_id, action.folder_id,
+                                    filename)
+                else:
+                    errors[action.filepath] = error
+            for action in chunk:
+                if action.filepath in errors:
+                    yield action._replace(
+                        action=FAILED,
+                        reason=str(errors[action.filepath])), False
+                else:
+                    yield action, action.action == BACKUP
+
+    def needs_hash(self, file_class):
+        """Return True if file_class must be hashed to tell whether its
+        content is already in Drive. Files whose size differs from the
+        Drive file are never hashed.
+
+        :type file_class: LocalFile
+        """
+        drive_file = file_class.file_found
+        if not self.checksum or not drive_file:
+            return False
+        if 'md5Checksum' not in drive_file:  # e.g. Google Docs files
+            return False
+        return int(drive_file.get('size', -1)) == file_class.size
+
+    def same_content(self, file_class):
+        """Return True if the Drive file found for file_class has the
+        same size and MD5 checksum as the local file.
+
+        :type file_class: LocalFile
+        """
+        if not self.needs_hash(file_class):
+            return False
+        return (file_class.md5(self.hash_cache) ==
+                file_class.file_found['md5Checksum'])
+
+    def hash_files(self, file_classes):
+        """Hash the files in file_classes that need comparing with
+        Drive and are not in the hash cache. With hash_workers, files are
+        hashed in parallel by a pool of processes; a file that can't be
+        read gets a failed action.
+
+        :type file_classes: list[LocalFile]
+        """
+        pending = [file_class for file_class in file_classes
+                   if self.needs_hash(file_class) and
+                   not file_class.has_md5(self.hash_cache)]
+        if not pending:
+            return
+        if self._hash_pool:
+            digests = [self._hash_pool.submit(file_md5, file_class.filepath)
+                       for file_class in pending]
+        else:
+            digests = [None] * len(pending)
+        for file_class, digest in zip(pending, digests):
+            try:
+                with self.phase('hash', file_class.filepath):
+                    if digest is None:
+                        md5 = file_md5(file_class.filepath)
+                    else:
+                        md5 = digest.result()
+            except (IOError, OSError) as error:
+                file_class.error = error
+                continue
+            file_class.set_md5(md5, self.hash_cache)
+
+    def backup_request(self, file_id, filename):
+        """Return the request flagging the Drive file file_id as
+        'no_overwrite', keeping it as a backup.
+
+        :type file_id: str
+        :type filename: str
+        """
+        return self.service.files().update(
+            fileId=file_id,
+            body={
+                'name': filename,
+                'properties': {'no_overwrite': 'true'}
+            }
+        )
+
+    def mark_backed_up(self, file_id, folder_id, filename):
+        """Record that the Drive file file_id was flagged as a backup.
+
+        :type file_id: str
+        :type folder_id: str
+        :type filename: str
+        """
+        self._update_index(folder_id, filename, None)
+        if self.remote_index:
+            self.remote_index.set_no_overwrite(file_id)
+
+    def is_stale(self, error):
+        """Return True if error means a file taken from the remote
+        index no longer exists in Drive.
+
+        :type error: Exception
+        """
+        return (self.remote_index is not None and
+                isinstance(error, HttpError) and error.resp.status == 404)
+
+    def drop_stale(self, file_id, folder_id, filename):
+        """Forget the Drive file file_id the remote index wrongly held,
+        and have its folder listed again on the next run.
+
+        :type file_id: str
+        :type folder_id: str
+        :type filename: str
+        """
+        print("File {} is no longer in GDrive, uploading it as a new "
+              "file.".format(filename))
+        self.remote_index.remove(file_id)
+        self.remote_index.invalidate(folder_id)
+        self._update_index(folder_id, filename, None)
+
+    def backup_file(self, file_class):
+        """Flag the Drive file found for file_class as a backup, so a
+        new file can be created next to it.
+
+        :type file_class: LocalFile
+        """
+        file_id = file_class.file_found['id']
+        try:
+            self.execute(self.backup_request(file_id, file_class.filename))
+        except HttpError as error:
+            if not self.is_stale(error):
+                raise
+            self.drop_stale(file_id, file_class.folder_id,
+                            file_class.filename)
+            return
+        self.mark_backed_up(file_id, file_class.folder_id,
+                            file_class.filename)
+
+    def update_file(self, file_class):
+        file_id = file_class.file_found['id']
+        try:
+            drive_file = self.execute_media(self.service.files().update(
+                fileId=file_id,
+                media_body=self.make_media(file_class),
+                body=file_class.file_metadata,
+                fields=self.mirror_fields
+            ), file_class, file_id)
+        except HttpError as error:
+            if not self.is_stale(error):
+                raise
+            self.drop_stale(file_id, file_class.folder_id,
+                            file_class.filename)
+            return self.upload_file(file_class)
+        return self.file_updated(file_class, drive_file)
+
+    def file_updated(self, file_class, drive_file):
+        """Record the update of the Drive file of file_class and return
+        UPDATED.
+
+        :type file_class: LocalFile
+        :type drive_file: dict
+        """
+        if self.remote_index:
+            self.remote_index.put(file_class.folder_id, drive_file)
+        print("File {} updated.\n".format(file_class.filepath))
+        return UPDATED
+
+    def upload_file(self, file_class):
+        drive_file = self.execute_media(self.service.files().create(
+            body=self.create_metadata(file_class),
+            media_body=self.make_media(file_class),
+            fields=self.mirror_fields), file_class, file_class.folder_id)
+        return self.file_created(file_class, drive_file)
+
+    def create_metadata(self, file_class):
+        """Return the metadata of a new Drive file for file_class.
+
+        :type file_class: LocalFile
+        """
+        if self.no_overwrite:
+            file_class.file_metadata['properties']['no_overwrite'] = 'true'
+        file_class.file_metadata['parents'] = [ file_class.folder_id ]
+        return file_class.file_metadata
+
+    def file_created(self, file_class, drive_file):
+        """Record the Drive file created for file_class and return
+        UPLOADED.
+
+        :type file_class: LocalFile
+        :type drive_file: dict
+        """
+        if not self.no_overwrite:
+            self._update_index(file_class.folder_id, file_class.filename,
+                               drive_file)
+        if self.remote_index:
+            self.remote_index.put(file_class.folder_id, drive_file)
+        print("File {} uploaded.\n".format(file_class.filepath))
+        return UPLOADED
+
+    def make_media(self, file_class):
+        """Return the media body for uploading file_class. Files larger
+        than resumable_threshold are sent as a resumable upload in
+        chunk_size pieces, smaller ones in a single multipart request.
+
+        :type file_class: LocalFile
+        """
+        if file_class.size > self.resumable_threshold:
+            return MediaFileUpload(file_class.filepath,
+                                   mimetype=self.mimetype,
+                                   chunksize=self.chunk_size,
+                                   resumable=True)
+        return MediaFileUpload(file_class.filepath, mimetype=self.mimetype)
+
+
+def media_http(http):
+    """Return http, made to hand Drive's 308 Resume Incomplete reply
+    to a resumable upload chunk back to next_chunk. httplib2 0.16 and
+    later follow a 308 as a redirect, and without a Location header
+    raise RedirectMissingLocation instead.
+
+    :type http: httplib2.Http
+    """
+    if hasattr(http, 'redirect_codes'):
+        http.redirect_codes = http.redirect_codes - {RESUME_INCOMPLETE}
+    return http
+
+
+class PooledHttp(httplib2.Http):
+    """httplib2.Http that reports every request to its ConnectionPool
+    as opening a new connection or reusing a kept-alive one.
+    """
+
+    def __init__(self, pool, **kwargs):
+        httplib2.Http.__init__(self, **kwargs)
+        self.pool = pool
+
+    def _conn_request(self, conn, request_uri, method, body, headers):
+        self.pool.count(getattr(conn, 'sock', None) is None)
+        return httplib2.Http._conn_request(self, conn, request_uri, method,
+                                           body, headers)
+
+
+class ConnectionPool(object):
+    """Pool of authorized Http objects shared by all threads. An Http
+    object keeps its connections alive between requests, and whichever
+    thread sends the next request gets the most recently used one, so
+    TLS connections outlive worker threads and runs.
+
+    An Http object holds at most one connection per host, so with
+    max_per_host no more Http objects are made than that, and threads
+    wait for one to be released instead.
+    """
+
+    def __init__(self, credentials, timeout=None, max_per_host=None,
+                 count=None):
+        self.credentials = credentials
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        self._count = count
+        self._idle = []
+        self._made = 0
+        self._condition = threading.Condition()
+
+    def new_http(self):
+        """Return a new authorized Http object of this pool."""
+        return self.credentials.authorize(
+            media_http(PooledHttp(self, timeout=self.timeout)))
+
+    def acquire(self):
+        """Take an idle Http object, or make one if none is idle and
+        max_per_host allows it, or else wait for one.
+        """
+        with self._condition:
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+                if not self.max_per_host or self._made < self.max_per_host:
+                    self._made += 1
+                    break
+                self._condition.wait()
+        return self.new_http()
+
+    def release(self, http):
+        """Give back an Http object taken with acquire.
+
+        :type http: httplib2.Http
+        """
+        with self._condition:
+            self._idle.append(http)
+            self._condition.notify()
+
+    def count(self, opened):
+        """Report a request that opened a connection (or reused one).
+
+        :type opened: bool
+        """
+        if self._count:
+            self._count(opened)
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter shared by all threads: rate tokens are
+    added per second, up to burst. Callers reserve their tokens under
+    the lock and sleep off any deficit outside it, so waiting callers
+    are served in arrival order.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """Take tokens and return the seconds until they are available,
+        without waiting.
+
+        :type tokens: int
+        """
+        with self._lock:
+            now = clock()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= tokens
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+
+class ConcurrencyController(object):
+    """AIMD controller for the number of files in flight, between 1 and
+    maximum. After every window of 2 * limit transfers it adds one slot
+    while throughput keeps rising, and gives one back when latency rose
+    without a throughput gain. When throughput has been flat for a few
+    windows it probes with one more slot, keeping it only if throughput
+    rises. Rate limit errors halve the limit, at most once per window.
+    Every decision is printed.
+    """
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = min(ADAPTIVE_INITIAL, maximum)
+        self._active = 0
+        self._condition = threading.Condition()
+        self._last_rate = None
+        self._last_latency = None
+        self._holds = 0
+        self._probing = False
+        self._start_window()
+
+    def wrap(self, process):
+        """Return process gated by the controller.
+
+        :type process: (object) -> FileResult
+        """
+        def gated(item):
+            self.acquire()
+            start = clock()
+            result = None
+            try:
+                result = process(item)
+                return result
+            finally:
+                self.release(clock() - start,
+                             result.sent if result else 0)
+        return gated
+
+    def acquire(self):
+        """Wait for a free slot."""
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+
+    def release(self, elapsed, sent):
+        """Free a slot, recording a transfer of sent bytes that took
+        elapsed seconds. Files that sent nothing are not measured.
+
+        :type elapsed: float
+        :type sent: int
+        """
+        with self._condition:
+            self._active -= 1
+            if sent:
+                self._files += 1
+                self._bytes += sent
+                self._latency += elapsed
+                if self._files >= 2 * self.limit:
+                    self._evaluate()
+            self._condition.notify_all()
+
+    def throttled(self):
+        """Halve the limit after a rate limit error."""
+        with self._condition:
+            if not self._decreased:
+                self._decreased = True
+                self._set(max(1, self.limit // 2), "rate limited by Drive")
+
+    def _start_window(self):
+        self._window_start = clock()
+        self._files = 0
+        self._bytes = 0
+        self._latency = 0.0
+        self._decreased = False
+
+    def _evaluate(self):
+        duration = max(clock() - self._window_start, 1e-6)
+        rate = self._bytes / duration
+        latency = self._latency / self._files
+        described = "{:.2f} MB/s, {:.2f}s per file".format(
+            rate / 1024 / 1024, latency)
+        probing, self._probing = self._probing, False
+        if self._decreased:
+            self._holds = 0
+        elif self._last_rate is None or (
+                rate > self._last_rate * (1 + ADAPTIVE_GAIN)):
+            self._holds = 0
+            self._set(min(self.maximum, self.limit + 1),
+                      "throughput rising, " + described)
+        elif probing:
+            self._set(max(1, self.limit - 1),
+                      "no gain from the extra slot, " + described)
+        elif (self._last_latency is not None and
+              latency > self._last_latency * ADAPTIVE_LATENCY_RISE):
+            self._holds = 0
+            self._set(max(1, self.limit - 1),
+                      "latency rising, " + described)
+        elif self._holds >= ADAPTIVE_PROBE_AFTER and (
+                self.limit < self.maximum):
+            self._holds = 0
+            self._probing = True
+            self._set(self.limit + 1, "probing, " + described)
+        else:
+            self._holds += 1
+            self._set(self.limit, described)
+        self._last_rate = rate
+        self._last_latency = latency
+        self._start_window()
+
+    def _set(self, limit, reason):
+        if limit == self.limit:
+            print("Concurrency stays at {} ({}).".format(limit, reason))
+        else:
+            print("Concurrency {} -> {} ({}).".format(self.limit, limit,
+                                                      reason))
+        self.limit = limit
+        self._condition.notify_all()
+
+
+class RunStats(object):
+    """Thread-safe counters collected during a run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = collections.defaultdict(int)
+
+    def add(self, name, amount=1):
+        """Add amount to the counter name.
+
+        :type name: str
+        :type amount: int | float
+        """
+        with self._lock:
+            self._counters[name] += amount
+
+    def __getitem__(self, name):
+        with self._lock:
+            return self._counters[name]
+
+
+class PhaseTimer(object):
+    """Thread-safe wall times of the phases (see PHASES) of every file
+    in a run, and counts of the API requests sent, by method ID.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = clock()
+        self.seconds = None
+        self.totals = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+        self.longest = collections.defaultdict(float)
+        # filepath -> phase -> seconds; None holds work shared by files.
+        self.files = collections.defaultdict(
+            lambda: collections.defaultdict(float))
+        self.calls = collections.Counter()
+
+    def record(self, name, filepath, seconds):
+        """Add seconds spent in phase name to filepath (None for work
+        shared by several files).
+
+        :type name: str
+        :type filepath: str | None
+        :type seconds: float
+        """
+        with self._lock:
+            self.totals[name] += seconds
+            self.counts[name] += 1
+            self.longest[name] = max(self.longest[name], seconds)
+            self.files[filepath][name] += seconds
+
+    def count(self, method_id):
+        """Count an API request of method_id.
+
+        :type method_id: str
+        """
+        with self._lock:
+            self.calls[method_id] += 1
+
+    def stop(self):
+        """Record the wall time of the whole run."""
+        self.seconds = clock() - self.started
+
+
+class Phase(object):
+    """Context manager adding the time spent in its block to a
+    PhaseTimer.
+    """
+    __slots__ = ('timer', 'name', 'filepath', 'start')
+
+    def __init__(self, timer, name, filepath):
+        self.timer = timer
+        self.name = name
+        self.filepath = filepath
+        self.start = None
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.record(self.name, self.filepath, clock() - self.start)
+        return False
+
+
+class NoPhase(object):
+    """Context manager that does nothing, used when timings are off."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_PHASE = NoPhase()
+
+
+FileResult = collections.namedtuple('FileResult',
+                                    ['filepath', 'status', 'error', 'sent'])
+FileResult.__new__.__defaults__ = (0,)  # bytes sent
+
+# What the planner decided for one file, and why. action is CREATE,
+# UPDATE, BACKUP, SKIP or FAILED; file_id is the Drive file updated or
+# backed up; modified and drive_modified are the local and Drive
+# 'modified' times.
+PlanAction = collections.namedtuple('PlanAction', [
+    'filepath', 'action', 'reason', 'folder_id', 'file_id', 'size',
+    'modified', 'drive_modified'])
+
+
+class LocalFile(object):
+    def __init__(self, local_file, home_dir):
+        self.filename = os.path.split(local_file)[-1]
+        if home_dir:
+            self.filepath = os.path.join(home_dir, local_file)
+        else:
+            self.filepath = local_file
+        self.stat = stat = os.stat(self.filepath)
+        self.file_last_update = int(stat.st_mtime)
+        self.size = stat.st_size
+        self.file_metadata = {
+            'name': self.filename,
+            'properties': {'modified': self.file_last_update}
+        }
+        self.folder_id = None
+        self.file_found = None
+        self.error = None
+        self.resumed_bytes = 0  # uploaded by an earlier, interrupted run
+        self._md5 = None
+
+    def md5(self, hash_cache=None):
+        """Return the hex MD5 digest of the file, hashing it on first
+        use unless hash_cache already knows it.
+
+        :type hash_cache: HashCache | None
+        """
+        if not self.has_md5(hash_cache):
+            self.set_md5(file_md5(self.filepath), hash_cache)
+        return self._md5
+
+    def has_md5(self, hash_cache=None):
+        """Return True if the MD5 digest is known without reading the
+        file.
+
+        :type hash_cache: HashCache | None
+        """
+        if self._md5 is None and hash_cache:
+            self._md5 = hash_cache.get(self.stat)
+        return self._md5 is not None
+
+    def set_md5(self, md5, hash_cache=None):
+        """Set the MD5 digest, recording it in hash_cache.
+
+        :type md5: str
+        :type hash_cache: HashCache | None
+        """
+        self._md5 = md5
+        if hash_cache:
+            hash_cache.put(self.filepath, self.stat, md5)
+
+    def session_key(self):
+        """Key of this file's resumable upload session: the session
+        is only reused while path, size and mtime are unchanged.
+        """
+        return "{}|{}|{}".format(os.path.abspath(self.filepath), self.size,
+                                 self.file_last_update)
+
+
+class FolderCache(object):
+    """On-disk cache of resolved Drive folders, mapping a folder_key
+    to its folder ID. Entries are validated by Uploader.cached_folder
+    before use.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as cache:
+                self._folders = json.load(cache)
+        except (IOError, OSError, ValueError):
+            self._folders = {}
+
+    def get(self, key):
+        """Return the cached folder ID for key, or None.
+
+        :type key: str
+        """
+        with self._lock:
+            return self._folders.get(key)
+
+    def put(self, key, folder_id):
+        """Cache folder_id for key.
+
+        :type key: str
+        :type folder_id: str
+        """
+        with self._lock:
+            if self._folders.get(key) != folder_id:
+                self._folders[key] = folder_id
+                self._write()
+
+    def remove(self, key):
+        """Forget key and every folder below it.
+
+        :type key: str
+        """
+        with self._lock:
+            stale = [cached for cached in self._folders
+                     if cached == key or cached.startswith(key + '/')]
+            for cached in stale:
+                del self._folders[cached]
+            if stale:
+                self._write()
+
+    def _write(self):
+        write_atomically(self.path, json.dumps(self._folders, indent=0,
+                                               sort_keys=True))
+
+
+class SessionJournal(object):
+    """On-disk journal of resumable upload sessions, mapping a
+    LocalFile.session_key to the session URI, the upload target and the
+    last byte offset Drive confirmed. Sessions of files that changed
+    since, and sessions older than Drive keeps them, are dropped on
+    load.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as journal:
+                sessions = json.load(journal)
+        except (IOError, OSError, ValueError):
+            sessions = {}
+        self._sessions = dict(
+            (key, session) for key, session in sessions.items()
+            if self._is_current(key, session))
+
+    @staticmethod
+    def _is_current(key, session):
+        if time.time() - session.get('saved', 0) > SESSION_LIFETIME:
+            return False
+        filepath, size, modified = key.rsplit('|', 2)
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return False
+        return (str(stat.st_size) == size and
+                str(int(stat.st_mtime)) == modified)
+
+    def get(self, key, target):
+        """Return the saved session for key if it uploads to target.
+
+        :type key: str
+        :type target: str
+        """
+        with self._lock:
+            session = self._sessions.get(key)
+        if session and session['target'] == target:
+            return session
+        return None
+
+    def save(self, key, target, uri, offset):
+        """Record the progress of a resumable upload.
+
+        :type key: str
+        :type target: str
+        :type uri: str
+        :type offset: int
+        """
+        with self._lock:
+            self._sessions[key] = {'target': target, 'uri': uri,
+                                   'offset': offset, 'saved': time.time()}
+            self._write()
+
+    def remove(self, key):
+        """Forget the session for key once the upload is complete.
+
+        :type key: str
+        """
+        with self._lock:
+            if self._sessions.pop(key, None) is not None:
+                self._write()
+
+    def _write(self):
+        write_atomically(self.path, json.dumps(self._sessions))
+
+
+def failed_result(filepath, error):
+    """Print and return the FileResult of a file that failed.
+
+    :type filepath: str
+    :type error: Exception
+    """
+    print("File {} failed: {}\n".format(filepath, error))
+    return FileResult(filepath, FAILED, str(error))
+
+
+def settled_result(action):
+    """Return the FileResult of an action that needs no request, a
+    skip or a failure, or None.
+
+    :type action: PlanAction
+    """
+    if action.action == FAILED:
+        return failed_result(action.filepath, action.reason)
+    if action.action == SKIP:
+        print("File {} was not uploaded, {}.\n".format(action.filepath,
+                                                       action.reason))
+        return FileResult(action.filepath, SKIPPED, None)
+    return None
+
+
+def failed_action(filepath, error):
+    """Return the PlanAction of a file that could not be planned.
+
+    :type filepath: str
+    :type error: Exception
+    """
+    return PlanAction(filepath, FAILED, str(error), None, None, None, None,
+                      None)
+
+
+def write_plan(path, actions):
+    """Atomically write actions to path as a JSON list of objects.
+
+    :type path: str
+    :type actions: list[PlanAction]
+    """
+    write_atomically(path, json.dumps(
+        [action._asdict() for action in actions], indent=1))
+
+
+def write_trace(path, results, timer):
+    """Atomically write a JSON line per FileResult of results to
+    path with the time spent in each of its phases, then a line with the
+    work shared by files, the API requests by method and the run time.
+
+    :type path: str
+    :type results: list[FileResult]
+    :type timer: PhaseTimer
+    """
+    records = [{'file': result.filepath,
+                'status': result.status,
+                'error': result.error,
+                'bytes': result.sent,
+                'phases': dict(timer.files.get(result.filepath, {}))}
+               for result in results]
+    records.append({'file': None,
+                    'phases': dict(timer.files.get(None, {})),
+                    'calls': dict(timer.calls),
+                    'seconds': timer.seconds})
+    write_atomically(path, "".join(json.dumps(record, sort_keys=True) + "\n"
+                                   for record in records))
+
+
+def write_metrics(path, results, stats, timer):
+    """Atomically write the metrics of the runs so far to path in the
+    Prometheus text format, for the node exporter's textfile collector:
+    files by outcome, bytes sent, API requests by method, retries, rate
+    limiter waits and a histogram of the upload time of each file sent,
+    and the duration and end time of the last run.
+
+    Counters and the histogram are running totals: the counts of this
+    run are added to those read back from path, so rate() and increase()
+    work across runs. A missing or unreadable file starts them over,
+    which Prometheus handles as a counter reset.
+
+    :type path: str
+    :type results: list[FileResult]
+    :type stats: RunStats
+    :type timer: PhaseTimer
+    """
+    previous = read_metrics(path)
+    outcomes = collections.OrderedDict(
+        (status, 0) for status in (UPLOADED, UPDATED, SKIPPED, FAILED))
+    for result in results:
+        outcomes[result.status] += 1
+    calls = collections.Counter(timer.calls)
+    method_prefix = 'driveuploader_api_requests_total{method="'
+    for sample in previous:
+        if sample.startswith(method_prefix):
+            calls.setdefault(sample[len(method_prefix):-2], 0)
+    latencies = []
+    for result in results:
+        phases = timer.files.get(result.filepath, {})
+        if 'upload' in phases or 'update' in phases:
+            latencies.append(phases.get('upload', 0) +
+                             phases.get('update', 0))
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append("# HELP driveuploader_{} {}".format(name, help_text))
+        lines.append("# TYPE driveuploader_{} {}".format(name, kind))
+        for suffix, labels, value in samples:
+            labels = "{{{}}}".format(",".join(
+                '{}="{}"'.format(label, label_value)
+                for label, label_value in labels)) if labels else ""
+            sample = "driveuploader_{}{}{}".format(name, suffix, labels)
+            if kind != 'gauge':
+                value += previous.get(sample, 0)
+            lines.append("{} {}".format(sample, format_sample(value)))
+
+    metric('runs_total', 'counter', "Runs finished.", [('', None, 1)])
+    metric('files_total', 'counter', "Files processed, by outcome.",
+           [('', [('status', status)], count)
+            for status, count in outcomes.items()])
+    metric('sent_bytes_total', 'counter',
+           "Bytes uploaded, without those of resumed uploads sent before.",
+           [('', None, sum(result.sent for result in results))])
+    metric('api_requests_total', 'counter', "API requests sent, by method.",
+           [('', [('method', method_id)], count)
+            for method_id, count in sorted(calls.items())])
+    metric('retries_total', 'counter', "Requests retried after an error.",
+           [('', None, stats['retries'])])
+    metric('drive_throttled_total', 'counter',
+           "Requests Drive rate limited (403 rate limit reasons, 429).",
+           [('', None, stats['drive_throttled'])])
+    metric('retry_seconds_total', 'counter',
+           "Seconds spent in retry backoff.",
+           [('', None, stats['retry_seconds'])])
+    metric('throttle_waits_total', 'counter',
+           "Requests delayed by the rate limiter.",
+           [('', None, stats['throttle_waits'])])
+    metric('throttle_seconds_total', 'counter',
+           "Seconds the rate limiter delayed requests.",
+           [('', None, stats['throttle_seconds'])])
+    buckets = [('_bucket', [('le', bound)],
+                sum(1 for latency in latencies if latency <= bound))
+               for bound in LATENCY_BUCKETS]
+    buckets.append(('_bucket', [('le', '+Inf')], len(latencies)))
+    buckets.append(('_sum', None, sum(latencies)))
+    buckets.append(('_count', None, len(latencies)))
+    metric('upload_seconds', 'histogram',
+           "Seconds taken to upload or update each file.", buckets)
+    metric('last_run_duration_seconds', 'gauge',
+           "Seconds the last run took.", [('', None, timer.seconds)])
+    metric('last_run_timestamp_seconds', 'gauge',
+           "Unix time the last run ended.", [('', None, time.time())])
+    write_atomically(path, "\n".join(lines) + "\n")
+
+
+def read_metrics(path):
+    """Return the samples of the metrics file path written by
+    write_metrics, as a dict of sample name with its labels to value.
+    Return an empty dict if the file is missing or unreadable.
+
+    :type path: str
+    """
+    samples = {}
+    try:
+        with open(path) as metrics:
+            for line in metrics:
+                if line.startswith('#') or not line.strip():
+                    continue
+                sample, value = line.rsplit(' ', 1)
+                samples[sample] = float(value)
+    except (IOError, OSError, ValueError):
+        return {}
+    return samples
+
+
+def format_sample(value):
+    """Format a metric value, whole numbers without a decimal point.
+
+    :type value: int | float
+    """
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def transfer_size(action):
+    """Return the number of bytes carrying out action will upload.
+
+    :type action: PlanAction
+    """
+    if action.action in (CREATE, UPDATE, BACKUP):
+        return action.size
+    return 0
+
+
+def lane_map(function, lanes, jobs):
+    """Apply function to every item of lanes, a list of item lists,
+    and return the results in the order of range(count of all items):
+    the items of all lanes together must be the integers below that
+    count. lanes[n] is worked from the front by jobs[n] threads, which
+    move on to the other lanes once their own is empty.
+
+    :type lanes: list[list[int]]
+    :type jobs: list[int]
+    """
+    queues = [collections.deque(lane) for lane in lanes]
+    results = [None] * sum(len(lane) for lane in lanes)
+    lock = threading.Lock()
+
+    def work(own):
+        preference = [queues[own]] + [queue for queue in queues
+                                      if queue is not queues[own]]
+        while True:
+            with lock:
+                queue = next((queue for queue in preference if queue), None)
+                if queue is None:
+                    return
+                index = queue.popleft()
+            results[index] = function(index)
+
+    with ThreadPoolExecutor(max_workers=sum(jobs)) as executor:
+        workers = [executor.submit(work, lane)
+                   for lane, count in enumerate(jobs)
+                   for _ in range(count)]
+        for worker in workers:
+            worker.result()
+    return results
+
+
+def ordered_map(executor, function, iterable, limit):
+    """Like executor.map, but only take up to limit items from iterable
+    ahead of the results, so a long or streamed input is never queued
+    all at once. Results are yielded in input order.
+
+    :type executor: concurrent.futures.Executor
+    :type limit: int
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def read_manifest(path, null=False):
+    """Yield the paths listed in the file path, or standard input if
+    path is '-', one per line or, with null, separated by NUL bytes.
+    The manifest is read in blocks, so paths are yielded before all of
+    it has arrived.
+
+    :type path: str
+    :type null: bool
+    """
+    separator = b'\0' if null else b'\n'
+    if path == '-':
+        manifest = getattr(sys.stdin, 'buffer', sys.stdin)
+    else:
+        manifest = open(path, 'rb')
+    try:
+        remainder = b''
+        while True:
+            block = manifest.read1(MANIFEST_BLOCK_SIZE) if hasattr(
+                manifest, 'read1') else manifest.read(MANIFEST_BLOCK_SIZE)
+            if not block:
+                break
+            entries = (remainder + block).split(separator)
+            remainder = entries.pop()
+            for entry in entries:
+                entry = decode_path(entry, null)
+                if entry:
+                    yield entry
+        entry = decode_path(remainder, null)
+        if entry:
+            yield entry
+    finally:
+        if manifest is not getattr(sys.stdin, 'buffer', sys.stdin):
+            manifest.close()
+
+
+def decode_path(entry, null):
+    """Decode a path read from a manifest. Newline separated entries
+    lose a trailing carriage return.
+
+    :type entry: bytes
+    :type null: bool
+    """
+    if not null and entry.endswith(b'\r'):
+        entry = entry[:-1]
+    try:
+        return os.fsdecode(entry)
+    except AttributeError:  # Python 2 paths are bytes
+        return entry
+
+
+def chunks(iterable, size):
+    """Yield lists of up to size items from iterable.
+
+    :type size: int
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class HashCache(object):
+    """SQLite cache of local file MD5 digests keyed by device, inode,
+    size and mtime, so unchanged files are not read again on later runs.
+    """
+
+    COMMIT_EVERY = 100
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, "
+            "path TEXT, md5 TEXT, PRIMARY KEY (device, inode))")
+        self._db.commit()
+
+    def get(self, stat):
+        """Return the cached MD5 of the file stat describes, or None.
+
+        :type stat: os.stat_result
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT md5 FROM hashes WHERE device=? AND inode=? AND "
+                "size=? AND mtime_ns=?",
+                (stat.st_dev, stat.st_ino, stat.st_size,
+                 mtime_ns(stat))).fetchone()
+        return row[0] if row else None
+
+    def put(self, filepath, stat, md5):
+        """Cache the MD5 of filepath, as it was when stat was taken.
+
+        :type filepath: str
+        :type stat: os.stat_result
+        :type md5: str
+        """
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                (stat.st_dev, stat.st_ino, stat.st_size, mtime_ns(stat),
+                 os.path.abspath(filepath), md5))
+            self._pending += 1
+            if self._pending >= self.COMMIT_EVERY:
+                self._db.commit()
+                self._pending = 0
+
+    def evict_missing(self):
+        """Drop the entries of files that no longer exist (or whose
+        path now holds another file) and commit the cache.
+        """
+        with self._lock:
+            stale = []
+            for device, inode, filepath in self._db.execute(
+                    "SELECT device, inode, path FROM hashes"):
+                try:
+                    stat = os.stat(filepath)
+                except OSError:
+                    stale.append((device, inode))
+                    continue
+                if (stat.st_dev, stat.st_ino) != (device, inode):
+                    stale.append((device, inode))
+            self._db.executemany(
+                "DELETE FROM hashes WHERE device=? AND inode=?", stale)
+            self._db.commit()
+            self._pending = 0
+
+
+class RemoteIndex(object):
+    """SQLite mirror of the Drive folders uploaded to: the id, name,
+    parents, size, MD5, modified property and no_overwrite flag of every
+    file in them, and when each folder was last listed. Files this run
+    creates, updates or backs up are written through, and everything
+    else is kept current from the Drive changes feed, whose cursor is
+    stored alongside.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # Every write is committed at once; in WAL mode that is cheap.
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        columns = [row[1] for row in
+                   self._db.execute("PRAGMA table_info(files)")]
+        if columns and 'position' not in columns:
+            # A mirror from before listing positions were stored: have
+            # every folder listed again.
+            self._db.executescript("DROP TABLE files;"
+                                   "DROP TABLE IF EXISTS folders;")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "id TEXT PRIMARY KEY, folder_id TEXT, name TEXT, parents TEXT, "
+            "size INTEGER, md5 TEXT, modified INTEGER, no_overwrite INTEGER, "
+            "description TEXT, properties TEXT, position INTEGER);"
+            "CREATE INDEX IF NOT EXISTS files_folder ON files (folder_id);"
+            "CREATE TABLE IF NOT EXISTS folders ("
+            "folder_id TEXT PRIMARY KEY, listed_at REAL);"
+            "CREATE TABLE IF NOT EXISTS state ("
+            "key TEXT PRIMARY KEY, value TEXT);")
+        self._db.commit()
+
+    def page_token(self):
+        """Return the changes feed cursor the mirror is current up to,
+        or None.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM state WHERE key='page_token'").fetchone()
+        return row[0] if row else None
+
+    def reset(self, page_token):
+        """Forget every mirrored folder, and follow the changes feed
+        from page_token on.
+
+        :type page_token: str
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM files")
+            self._db.execute("DELETE FROM folders")
+            self._set_page_token(page_token)
+            self._db.commit()
+
+    def apply_changes(self, changes, page_token):
+        """Apply one page of the changes feed and move the cursor to
+        page_token, in a single transaction. Changes to files outside
+        the mirrored folders are dropped before they touch the database,
+        except that files moved out of a mirrored folder are forgotten.
+
+        :type changes: list[dict]
+        :type page_token: str
+        """
+        with self._lock:
+            folders = set(row[0] for row in self._db.execute(
+                "SELECT folder_id FROM folders"))
+            for change in changes:
+                if 'fileId' not in change:  # a shared drive changed
+                    continue
+                drive_file = change.get('file')
+                if change.get('removed') or drive_file.get('trashed'):
+                    self._db.execute("DELETE FROM files WHERE id=?",
+                                     (change['fileId'],))
+                    if change['fileId'] in folders:
+                        self._drop_folder(change['fileId'])
+                    continue
+                if drive_file['mimeType'] == FOLDER_MIMETYPE:
+                    continue
+                in_scope = [parent for parent in
+                            drive_file.get('parents') or []
+                            if parent in folders]
+                if in_scope:
+                    self._put(in_scope[0], drive_file)
+                else:
+                    self._db.execute("DELETE FROM files WHERE id=?",
+                                     (change['fileId'],))
+            self._set_page_token(page_token)
+            self._db.commit()
+
+    def _set_page_token(self, page_token):
+        self._db.execute(
+            "INSERT OR REPLACE INTO state VALUES ('page_token', ?)",
+            (page_token,))
+
+    def _drop_folder(self, folder_id):
+        self._db.execute("DELETE FROM files WHERE folder_id=?", (folder_id,))
+        self._db.execute("DELETE FROM folders WHERE folder_id=?",
+                         (folder_id,))
+
+    def listed_at(self, folder_id):
+        """Return when folder_id was last listed from Drive, or None.
+
+        :type folder_id: str
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT listed_at FROM folders WHERE folder_id=?",
+                (folder_id,)).fetchone()
+        return row[0] if row else None
+
+    def files(self, folder_id):
+        """Return the metadata of the files mirrored in folder_id, in
+        the order Drive listed them.
+
+        :type folder_id: str
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, name, parents, size, md5, description, "
+                "properties FROM files WHERE folder_id=? ORDER BY position",
+                (folder_id,)).fetchall()
+        drive_files = []
+        for file_id, name, parents, size, md5, description, properties \
+                in rows:
+            drive_file = {'id': file_id, 'name': name,
+                          'parents': json.loads(parents),
+                          'properties': json.loads(properties)}
+            if size is not None:
+                drive_file['size'] = str(size)
+            if md5 is not None:
+                drive_file['md5Checksum'] = md5
+            if description is not None:
+                drive_file['description'] = description
+            drive_files.append(drive_file)
+        return drive_files
+
+    def replace_folder(self, folder_id, drive_files):
+        """Replace the mirror of folder_id with a fresh listing.
+
+        :type folder_id: str
+        :type drive_files: list[dict]
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM files WHERE folder_id=?",
+                             (folder_id,))
+            self._db.executemany(
+                "INSERT OR REPLACE INTO files VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [self._row(folder_id, drive_file) + (position,)
+                 for position, drive_file in enumerate(drive_files)])
+            self._db.execute("INSERT OR REPLACE INTO folders VALUES (?, ?)",
+                             (folder_id, time.time()))
+            self._db.commit()
+
+    def put(self, folder_id, drive_file):
+        """Mirror a file this run created or updated in folder_id.
+
+        :type folder_id: str
+        :type drive_file: dict
+        """
+        with self._lock:
+            self._put(folder_id, drive_file)
+            self._db.commit()
+
+    def set_no_overwrite(self, file_id):
+        """Record that file_id was flagged as a backup.
+
+        :type file_id: str
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT properties FROM files WHERE id=?",
+                (file_id,)).fetchone()
+            if row is None:
+                return
+            properties = json.loads(row[0])
+            properties['no_overwrite'] = 'true'
+            self._db.execute(
+                "UPDATE files SET no_overwrite=1, properties=? WHERE id=?",
+                (json.dumps(properties), file_id))
+            self._db.commit()
+
+    def remove(self, file_id):
+        """Forget file_id.
+
+        :type file_id: str
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM files WHERE id=?", (file_id,))
+            self._db.commit()
+
+    def invalidate(self, folder_id):
+        """Have folder_id listed from Drive again the next time it is
+        needed.
+
+        :type folder_id: str
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM folders WHERE folder_id=?",
+                             (folder_id,))
+            self._db.commit()
+
+    def _put(self, folder_id, drive_file):
+        # A file keeps its place in the listing when it changes, and
+        # new files are added last.
+        self._db.execute(
+            "INSERT OR REPLACE INTO files VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, COALESCE("
+            "(SELECT position FROM files WHERE id=? AND folder_id=?), "
+            "(SELECT IFNULL(MAX(position), -1) + 1 FROM files "
+            "WHERE folder_id=?)))",
+            self._row(folder_id, drive_file) +
+            (drive_file['id'], folder_id, folder_id))
+
+    @staticmethod
+    def _row(folder_id, drive_file):
+        properties = drive_file.get('properties') or {}
+        size = drive_file.get('size')
+        return (drive_file['id'], folder_id, drive_file['name'],
+                json.dumps(drive_file.get('parents') or [folder_id]),
+                int(size) if size is not None else None,
+                drive_file.get('md5Checksum'),
+                drive_modified(drive_file),
+                properties.get('no_overwrite') == 'true',
+                drive_file.get('description'),
+                json.dumps(properties))
+
+
+def mtime_ns(stat):
+    """Return the modification time of stat in nanoseconds.
+
+    :type stat: os.stat_result
+    """
+    try:
+        return stat.st_mtime_ns
+    except AttributeError:  # Python 2
+        return int(stat.st_mtime * 1e9)
+
+
+def walk_files(top):
+    """Yield (path, drive_dir) for every file below the directory top,
+    depth first and sorted by name. drive_dir is the '/' separated path
+    of the file's directory, starting with top's own name. Directories
+    are read with os.scandir one at a time, so memory use does not grow
+    with the size of the tree. Symbolic links to directories are not
+    followed.
+
+    :type top: str
+    """
+    name = os.path.basename(os.path.abspath(top))
+    stack = [(top, name)]
+    while stack:
+        directory, drive_dir = stack.pop()
+        subdirectories = []
+        for entry in sorted(scandir(directory), key=lambda entry: entry.name):
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(
+                    (entry.path, drive_dir + '/' + entry.name))
+            elif entry.is_file():
+                yield entry.path, drive_dir
+        stack.extend(reversed(subdirectories))
+
+
+def file_md5(filepath):
+    """Return the hex MD5 digest of filepath, read in blocks so large
+    files are never held in memory. Files over MMAP_THRESHOLD are
+    hashed straight from a memory map instead of through read() copies.
+
+    :type filepath: str
+    """
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as local_file:
+        size = os.fstat(local_file.fileno()).st_size
+        if size > MMAP_THRESHOLD:
+            mapped = mmap.mmap(local_file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+            try:
+                md5.update(mapped)
+            finally:
+                mapped.close()
+        else:
+            for block in iter(lambda: local_file.read(HASH_BLOCK_SIZE), b''):
+                md5.update(block)
+    return md5.hexdigest()
+
+
+def drive_modified(drive_file):
+    """Return the 'modified' property of drive_file, or None.
+
+    :type drive_file: dict
+    """
+    try:
+        return int(drive_file['properties']['modified'])
+    except KeyError:
+        return None
+
+
+def write_atomically(path, text):
+    """Write text to path through a temporary file moved over it, so
+    path never holds a partly written file.
+
+    :type path: str
+    :type text: str
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as temp_file:
+        temp_file.write(text)
+    replace_file(temp_path, path)
+
+
+def replace_file(source, destination):
+    """Atomically move source over destination where the platform
+    allows it.
+
+    :type source: str
+    :type destination: str
+    """
+    try:
+        os.replace(source, destination)
+    except AttributeError:  # Python 2
+        if os.name == 'nt' and os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+
+def parse_bytes(value):
+    """Parse a size such as '262144', '512K' or '8M' into bytes.
+
+    :type value: str
+    """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = value.strip().upper().rstrip('B')
+    multiplier = units.get(text[-1:], 1)
+    if text[-1:] in units:
+        text = text[:-1]
+    try:
+        size = int(float(text) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid size: '{}'".format(value))
+    if size <= 0:
+        raise argparse.ArgumentTypeError(
+            "size must be positive: '{}'".format(value))
+    return size
+
+
+def parse_size(value):
+    """Parse a chunk size like parse_bytes, rounded up to a multiple of
+    CHUNK_GRANULARITY.
+
+    :type value: str
+    """
+    size = parse_bytes(value)
+    return -(-size // CHUNK_GRANULARITY) * CHUNK_GRANULARITY
+
+
+def error_reason(error):
+    """Return the reason of the first error in an HttpError's body,
+    e.g. 'userRateLimitExceeded', or None.
+
+    :type error: HttpError
+    """
+    try:
+        content = error.content.decode('utf-8')
+        return json.loads(content)['error']['errors'][0]['reason']
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def describe_error(error):
+    """Return a short description of an API or transport error, e.g.
+    'HTTP 503 (backendError)' or 'timeout: timed out'.
+
+    :type error: Exception
+    """
+    if isinstance(error, HttpError):
+        return "HTTP {} ({})".format(error.resp.status,
+                                     error_reason(error) or 'no reason')
+    return "{}: {}".format(type(error).__name__, error)
+
+
+def is_rate_limited(error):
+    """Return True for rate limit errors (403 rate limit reasons, 429).
+
+    :type error: Exception
+    """
+    if not isinstance(error, HttpError):
+        return False
+    status = int(error.resp.status)
+    if status == 403:
+        return error_reason(error) in RATE_LIMIT_REASONS
+    return status == 429
+
+
+def is_retryable(error):
+    """Return True for rate limit (403 or 429), server (5xx) and
+    transport errors.
+
+    :type error: Exception
+    """
+    if isinstance(error, TRANSPORT_ERRORS):
+        return True
+    return is_rate_limited(error) or int(error.resp.status) >= 500
+
+
+def folder_key(folder_name):
+    """Return the cache key of a --folder value: '' for the My Drive
+    root, '/a/b/c' for a path and the bare name for a single folder
+    name, which is searched for in the whole Drive.
+
+    :type folder_name: str | None
+    """
+    names = [name for name in (folder_name or '').split('/') if name]
+    if not names or names == ['root']:
+        return ''
+    if len(names) == 1 and '/' not in folder_name:
+        return names[0]
+    return '/' + '/'.join(names)
+
+
+def is_missing(folder_id):
+    """Return True if folder_id was made up by check for a folder
+    that is not in Drive.
+
+    :type folder_id: str
+    """
+    return folder_id.startswith(MISSING_FOLDER)
+
+
+def escape_query(value):
+    """Escape a value for use inside a quoted Drive query string.
+
+    :type value: str
+    """
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+
+def parse_check(local_update, drive_update, filename):
+    """Parse strings for printing information for 'check' option.
+
+    :type local_update: int
+    :type drive_update: int | None
+    :type filename: str
+    """
+    time_string = "%Y-%m-%d, %H:%M:%S"
+    local_mod_time = time.strftime(time_string,
+                                   time.localtime(local_update))
+    if drive_update:
+        drive_mod_time = time.strftime(time_string,
+                                       time.localtime(drive_update))
+    else:
+        drive_mod_time = "Undefined"
+    return ("{}:\n  Local file last updated: {}\n  Remote file last updated: "
+        "{}\n").format(filename, local_mod_time, drive_mod_time)
+
+def print_plan(actions):
+    """Print the last modified dates and the planned action of every
+    file, in file_list order, followed by a count of each action.
+
+    :type actions: list[PlanAction]
+    """
+    counts = collections.OrderedDict(
+        (action, 0) for action in (CREATE, UPDATE, BACKUP, SKIP, FAILED))
+    for action in actions:
+        counts[action.action] += 1
+        if action.action == FAILED:
+            print("File {} failed: {}\n".format(action.filepath,
+                                                action.reason))
+            continue
+        print(parse_check(action.modified, action.drive_modified,
+                          action.filepath), end='')
+        print("  Plan: {}, {}\n".format(action.action, action.reason))
+    print("Plan: " + ", ".join("{} {}".format(count, action)
+                               for action, count in counts.items()))
+
+def print_results(results):
+    """Print the outcome of every file, in file_list order, followed
+    by a count of each outcome.
+
+    :type results: list[FileResult]
+    """
+    counts = collections.OrderedDict(
+        (status, 0) for status in (UPLOADED, UPDATED, SKIPPED, FAILED))
+    print("Results:")
+    for result in results:
+        counts[result.status] += 1
+        if result.error:
+            print("  {}: {} ({})".format(result.status, result.filepath,
+                                       result.error))
+        else:
+            print("  {}: {}".format(result.status, result.filepath))
+    print(", ".join("{} {}".format(count, status)
+                    for status, count in counts.items()))
+
+def print_stats(stats):
+    """Print the counters of a run that are worth reporting.
+
+    :type stats: RunStats
+    """
+    if stats['retries']:
+        print("Retried {} requests, {:.1f}s spent in backoff.".format(
+            stats['retries'], stats['retry_seconds']))
+    if stats['drive_throttled']:
+        print("Drive rate limited {} requests.".format(
+            stats['drive_throttled']))
+    if stats['throttle_waits']:
+        print("Rate limiter delayed {} requests by {:.1f}s in total.".format(
+            stats['throttle_waits'], stats['throttle_seconds']))
+    if stats['connections_opened']:
+        print("Opened {} connections, reused them for {} requests.".format(
+            stats['connections_opened'], stats['connections_reused']))
+    if stats['changes']:
+        print("Applied {} changes from Drive to the remote index.".format(
+            stats['changes']))
+
+def print_timings(timer):
+    """Print the time spent in each phase and the API requests sent.
+
+    :type timer: PhaseTimer
+    """
+    print("{:<8} {:>6} {:>9} {:>9} {:>9}".format(
+        'phase', 'count', 'total s', 'mean ms', 'max ms'))
+    for name in PHASES:
+        count = timer.counts.get(name)
+        if not count:
+            continue
+        total = timer.totals[name]
+        print("{:<8} {:>6} {:>9.3f} {:>9.1f} {:>9.1f}".format(
+            name, count, total, total / count * 1000,
+            timer.longest[name] * 1000))
+    print("Run took {:.3f}s.".format(timer.seconds))
+    if timer.calls:
+        print("API requests: {}, {}.".format(
+            sum(timer.calls.values()),
+            ", ".join("{} {}".format(method_id, count) for method_id, count
+                      in sorted(timer.calls.items()))))
+
+
+def main(check=False, force=False, **kwargs):
+    gdrive = Uploader(**kwargs)
+    if check:
+        gdrive.upload(check=True)
+    elif force:
+        gdrive.upload(force=True)
+    else:
+        gdrive.upload()
+
+
+if __name__ == '__main__':
+
+    arg_help = [
+        "Save or overwrite files to Google Drive. The last modified date of "
+            "the file is written to a custom property, and will only overwrite"
+            " without --force if this date is before the file's last modified "
+            "date.",
+        "Files list separated by comma (no spaces, use quotes). (required "
+            "unless --from-file is used).",
+        "Home directory to look for items in file_list. Will use home "
+            "directory instead of current working directory.",
+        "Folder name to upload files to in Google Drive. If omitted, files "
+            "will be placed in root directory. A path such as a/b/c is "
+            "looked up from the root directory, creating missing folders.",
+        "Force overwrite.",
+        "Prints last modified dates and whether each file would be "
+            "created, updated, backed up or skipped, and why, without "
+            "changing anything in Drive: missing folders are not created. "
+            "Folders are listed instead of queried per file.",
+        "Set the mimetype for all files to be uploaded. Generally, Google "
+            "Drive handles this automatically. Use 'text/plain' to force a "
+            "file to work with Drive editors like Drive Notepad.",
+        "Set a description to all files to be uploaded, visible in GDrive "
+            "app (use quotes). Use --description=\" \" to remove description.",
+        "Add files without overwriting. 'no_overwrite' files will be flagged "
+            "with a custom property and will never be found by the script.",
+        "Enable the 'Press enter to close.' prompt at script end.",
+        "Keep the old file instead of overwriting.",
+        "Number of files to upload concurrently (default 1).",
+        "List the Drive folder once and look files up in that listing "
+            "instead of querying Drive for every file.",
+        "Send Drive lookups and backup renames as batch requests of up "
+            "to 100 files.",
+        "Chunk size for resumable uploads of files over 5MB, e.g. 512K or "
+            "16M (default 8M). Rounded up to a multiple of 256K.",
+        "Compare MD5 checksums and skip files whose content is already in "
+            "Drive, even with --force.",
+        "Number of processes hashing files for --checksum (default 1).",
+        "Times to retry a request after a rate limit or server error "
+            "(default 5).",
+        "Limit API requests to this many per second, across all jobs.",
+        "Number of requests that may be sent at once before --rate "
+            "applies (default: one second's worth).",
+        "Adapt the number of files in flight to throughput, latency and "
+            "rate limiting, using --jobs as the maximum.",
+        "Upload directories in file_list with everything below them, "
+            "mirroring their tree as Drive folders.",
+        "Read the files to upload from PATH, one per line, instead of "
+            "file_list. Use - to read standard input.",
+        "Paths in the --from-file manifest are separated by NUL "
+            "characters, as written by find -print0.",
+        "Remember resolved Drive folders between runs in "
+            "folder_cache.json.",
+        "Keep a local mirror of the Drive folders uploaded to in "
+            "drive_index.sqlite3 and plan uploads from it instead of "
+            "listing the folders every run. Implies --index_folder.",
+        "Seconds before a folder in the --remote_index mirror is listed "
+            "from Drive again in full; in between it is kept current from "
+            "the Drive changes feed (default 604800, one week).",
+        "Write the upload plan (the action and reason for every file) to "
+            "PATH as JSON, before anything is uploaded.",
+        "Order in which files are uploaded: fifo (file list order, the "
+            "default), largest-first or smallest-first. Except with fifo, "
+            "files of 64M or more are uploaded in a separate lane by a "
+            "quarter of the jobs while the others work the smaller files.",
+        "Seconds a connection may wait for Drive to send or accept data "
+            "(default 60).",
+        "Most connections kept open to one host; requests wait for a free "
+            "one (default: one per job).",
+        "Upload with a pool of threads (the default), or with 'async', "
+            "asyncio and aiohttp on a single thread, with --jobs files in "
+            "flight. Requires Python 3 and aiohttp.",
+        "Time every phase of every file (stat, folder, lookup, hash, "
+            "backup, upload, update) and count the API requests by method, "
+            "printing a summary table at the end.",
+        "Write the phase timings of every file to this file as JSON lines, "
+            "one per file and a last one for the whole run. Implies "
+            "--timings.",
+        "At the end of the run, add its outcome counts, bytes sent, API "
+            "requests, retries, rate limiter waits and upload latency "
+            "histogram to the totals in this file, and record its duration, "
+            "in the Prometheus text format, for the node exporter's textfile "
+            "collector (use a .prom file in its directory)."
+    ]
+
+    parent = tools.argparser
+    group = parent.add_argument_group('standard')
+    exclusive_group = parent.add_mutually_exclusive_group()
+    parent.add_argument("file_list", help=arg_help[1], nargs='?')
+    parent.add_argument("-d", "--home_dir", help=arg_help[2])
+    parent.add_argument("--folder", help=arg_help[3])
+    exclusive_group.add_argument("--force",
+                                 help=arg_help[4],
+                                 action='store_true')
+    exclusive_group.add_argument("-c",
+                                 "--check",
+                                 help=arg_help[5],
+                                 action='store_true')
+    parent.add_argument("--mimetype", help=arg_help[6])
+    parent.add_argument("--description", help=arg_help[7])
+    exclusive_group.add_argument("--no_overwrite",
+                        help=arg_help[8],
+                        action='store_true')
+    parent.add_argument("--prompt",
                         help=arg_help[9],
                         action='store_true')
     parent.add_argument("--backup",
                         help=arg_help[10],
                         action='store_true')
-    flags = argparse.ArgumentParser(
+    parent.add_argument("-j", "--jobs",
+                        help=arg_help[11],
+                        type=int,
+                        default=1)
+    parent.add_argument("--index_folder",
+                        help=arg_help[12],
+                        action='store_true')
+    parent.add_argument("--batch",
+                        help=arg_help[13],
+                        action='store_true')
+    parent.add_argument("--chunk-size",
+                        help=arg_help[14],
+                        type=parse_size,
+                        default=DEFAULT_CHUNK_SIZE)
+    parent.add_argument("--checksum",
+                        help=arg_help[15],
+                        action='store_true')
+    parent.add_argument("--hash_workers",
+                        help=arg_help[16],
+                        type=int,
+                        default=1)
+    parent.add_argument("--retries",
+                        help=arg_help[17],
+                        type=int,
+                        default=DEFAULT_RETRIES)
+    parent.add_argument("--rate",
+                        help=arg_help[18],
+                        type=float)
+    parent.add_argument("--burst",
+                        help=arg_help[19],
+                        type=int)
+    parent.add_argument("--adaptive",
+                        help=arg_help[20],
+                        action='store_true')
+    parent.add_argument("-r", "--recursive",
+                        help=arg_help[21],
+                        action='store_true')
+    parent.add_argument("--from-file",
+                        help=arg_help[22],
+                        metavar='PATH')
+    parent.add_argument("--null",
+                        help=arg_help[23],
+                        action='store_true')
+    parent.add_argument("--folder_cache",
+                        help=arg_help[24],
+                        action='store_true')
+    parent.add_argument("--remote_index",
+                        help=arg_help[25],
+                        action='store_true')
+    parent.add_argument("--index_ttl",
+                        help=arg_help[26],
+                        type=float,
+                        default=REMOTE_INDEX_TTL)
+    parent.add_argument("--plan",
+                        help=arg_help[27],
+                        metavar='PATH')
+    parent.add_argument("--order",
+                        help=arg_help[28],
+                        choices=ORDERS,
+                        default=FIFO)
+    parent.add_argument("--timeout",
+                        help=arg_help[29],
+                        type=float,
+                        default=DEFAULT_TIMEOUT)
+    parent.add_argument("--max_per_host",
+                        help=arg_help[30],
+                        type=int)
+    parent.add_argument("--engine",
+                        help=arg_help[31],
+                        choices=(SYNC_ENGINE, ASYNC_ENGINE),
+                        default=SYNC_ENGINE)
+    parent.add_argument("--timings",
+                        help=arg_help[32],
+                        action='store_true')
+    parent.add_argument("--trace", help=arg_help[33])
+    parent.add_argument("--metrics",
+                        help=arg_help[34],
+                        metavar='PATH')
+    parser = argparse.ArgumentParser(
         parents=[parent],
         description=arg_help[0]
-    ).parse_args()
+    )
+    flags = parser.parse_args()
+    if not flags.file_list and not flags.from_file:
+        parser.error("file_list or --from-file is required")
     kw_args = vars(flags)
 
     main(**kw_args)
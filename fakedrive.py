@@ -0,0 +1,1008 @@
+"""In-process fake of the Google Drive v3 API, for tests and benchmarks.
+
+FakeDrive serves, over HTTP on localhost, the discovery document and
+the Drive v3 endpoints driveuploader uses: files.list (with q, paging
+and fields), files.get, files.create and files.update (metadata only,
+multipart and resumable uploads), changes.getStartPageToken,
+changes.list and batch requests. Files only keep their metadata, the
+size and the MD5 of their content.
+
+Latency, rate limiting and failures can be injected:
+
+    with FakeDrive(latency=0.02, rate=100) as drive:
+        drive.fail(status=503, method='drive.files.create')
+        uploader = driveuploader.Uploader(file_list='README.md',
+                                          api_url=drive.url,
+                                          credentials=drive.credentials())
+        uploader.upload()
+        print(drive.calls)
+"""
+from __future__ import print_function
+
+import collections
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, unquote, urlsplit
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import parse_qsl, urlsplit
+
+from oauth2client import client
+
+
+ACCESS_TOKEN = 'fakedrive-token'
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+DEFAULT_MIMETYPE = 'application/octet-stream'
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_SIZE = 100
+FILE_DEFAULT_FIELDS = 'kind, id, name, mimeType'
+LIST_DEFAULT_FIELDS = 'kind, nextPageToken, files({})'.format(
+    FILE_DEFAULT_FIELDS)
+UPLOAD_PATHS = ('upload/drive/v3/files', 'resumable/upload/drive/v3/files')
+
+
+class FakeDrive(object):
+    """A Drive v3 server on host:port (port 0 picks a free one).
+
+    latency: seconds every API call takes, e.g. a round-trip time.
+    bandwidth: bytes per second of the link every request body is sent
+        over, shared by all connections.
+    rate: most API calls per second; calls over it fail with 403
+        userRateLimitExceeded, like Drive's per-user limit.
+    error_rate: share of API calls failing with 500 backendError.
+    seed: seed of the random error_rate failures.
+
+    Batch sub-requests and the chunks of resumable uploads are API
+    calls of their own. calls counts them by method ID (e.g.
+    'drive.files.list'), and connections counts the TCP connections
+    accepted.
+    """
+
+    def __init__(self, latency=0.0, rate=None, error_rate=0.0, seed=None,
+                 bandwidth=None, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.rate = rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.files = {}
+        self.calls = collections.Counter()
+        self.connections = 0
+        self._changes = []  # IDs of changed files, oldest first
+        self._sessions = {}
+        self._failures = []
+        self._recent = collections.deque()  # times of the last second's calls
+        self._link_free = 0  # when the simulated link is next idle
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+        self.server = FakeDriveServer((host, port), FakeDriveHandler)
+        self.server.drive = self
+        self.url = 'http://{}:{}/'.format(host, self.server.server_address[1])
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """Serve requests from a background thread."""
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the listening socket."""
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+    def credentials(self):
+        """Return credentials the fake accepts, for Uploader(credentials=)."""
+        return client.AccessTokenCredentials(ACCESS_TOKEN, 'fakedrive')
+
+    def fail(self, status=500, reason='backendError', count=1, method=None,
+             after=0):
+        """Fail count calls of method (any method if None, 'batch' for
+        a whole batch request) with an error response of status and
+        reason, once after calls of it went through. Failures are
+        injected in the order they were asked for.
+
+        :type status: int
+        :type reason: str
+        :type count: int
+        :type method: str | None
+        :type after: int
+        """
+        with self._lock:
+            self._failures.append([method, status, reason, after, count])
+
+    def expire_sessions(self):
+        """Forget every resumable upload session, as Drive does a week
+        after they are started.
+        """
+        with self._lock:
+            self._sessions.clear()
+
+    def add_file(self, name, parents=('root',), content=b'', **metadata):
+        """Store a file directly, without an API call, and return it.
+
+        :type name: str
+        :type parents: collections.Iterable[str]
+        :type content: bytes
+        """
+        metadata.update(name=name, parents=list(parents))
+        with self._lock:
+            return self._create(metadata, content_info(content))
+
+    def folder(self, name, parents=('root',)):
+        """Store a folder directly and return it.
+
+        :type name: str
+        :type parents: collections.Iterable[str]
+        """
+        return self.add_file(name, parents, None, mimeType=FOLDER_MIMETYPE)
+
+    def reset(self):
+        """Forget every file, change, session, call and failure."""
+        with self._lock:
+            self.files.clear()
+            self.calls.clear()
+            self.connections = 0
+            del self._changes[:]
+            self._sessions.clear()
+            del self._failures[:]
+
+    def transfer(self, size):
+        """Wait until size bytes have gone over the simulated link.
+        Transfers queue for the link, so concurrent uploads share it.
+
+        :type size: int
+        """
+        if not self.bandwidth or not size:
+            return
+        with self._lock:
+            now = time.time()
+            self._link_free = max(now, self._link_free) + \
+                float(size) / self.bandwidth
+            wait = self._link_free - now
+        time.sleep(wait)
+
+    def handle(self, method, path, query, headers, body):
+        """Return (status, headers, body) of the response to a request.
+
+        :type method: str
+        :type path: str
+        :type query: dict
+        :type headers: dict
+        :type body: bytes
+        """
+        if path == 'discovery/v1/apis/drive/v3/rest':
+            return json_response(discovery_document(self.url))
+        if headers.get('authorization') != 'Bearer ' + ACCESS_TOKEN:
+            return error_response(401, 'authError', 'Invalid Credentials')
+        if path.startswith('batch') and method == 'POST':
+            return self.batch(headers, body)
+        route = self.route(method, path, query)
+        if route is None:
+            return error_response(404, 'notFound', 'Not Found')
+        method_id, call, args = route
+        with self._lock:
+            self.calls[method_id] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        failure = self.injected_failure(method_id)
+        if failure:
+            return failure
+        try:
+            return call(query, headers, body, *args)
+        except FakeDriveError as error:
+            return error.response()
+
+    def route(self, method, path, query):
+        """Return (method ID, handler, path arguments) for a request, or
+        None if there is no such endpoint.
+        """
+        parts = path.split('/')
+        if path in UPLOAD_PATHS or path.rsplit('/', 1)[0] in UPLOAD_PATHS:
+            file_id = parts[-1] if parts[-1] != 'files' else None
+            if file_id:
+                method_id = 'drive.files.update'
+            else:
+                method_id = 'drive.files.create'
+            if method == 'PUT' and 'upload_id' in query:
+                return method_id, self.upload_chunk, ()
+            if (method, bool(file_id)) in (('POST', False), ('PATCH', True)):
+                return method_id, self.upload, (file_id,)
+            return None
+        if parts[:2] != ['drive', 'v3']:
+            return None
+        parts = parts[2:]
+        if parts == ['files']:
+            return {
+                'GET': ('drive.files.list', self.list_files, ()),
+                'POST': ('drive.files.create', self.create_file, ()),
+            }.get(method)
+        if len(parts) == 2 and parts[0] == 'files':
+            return {
+                'GET': ('drive.files.get', self.get_file, (parts[1],)),
+                'PATCH': ('drive.files.update', self.update_file,
+                          (parts[1],)),
+            }.get(method)
+        if parts == ['changes', 'startPageToken'] and method == 'GET':
+            return ('drive.changes.getStartPageToken', self.start_page_token,
+                    ())
+        if parts == ['changes'] and method == 'GET':
+            return 'drive.changes.list', self.list_changes, ()
+        return None
+
+    def injected_failure(self, method_id):
+        """Return the error response of an injected failure for a call
+        of method_id, or None.
+        """
+        with self._lock:
+            for index, failure in enumerate(self._failures):
+                method, status, reason, after, count = failure
+                if method not in (None, method_id):
+                    continue
+                if after:
+                    failure[3] -= 1
+                    break
+                if count > 1:
+                    failure[4] -= 1
+                else:
+                    del self._failures[index]
+                return error_response(status, reason, 'Injected failure')
+            if self.rate:
+                now = time.time()
+                while self._recent and self._recent[0] <= now - 1:
+                    self._recent.popleft()
+                if len(self._recent) >= self.rate:
+                    return error_response(403, 'userRateLimitExceeded',
+                                          'User Rate Limit Exceeded')
+                self._recent.append(now)
+            if self.error_rate and self.random.random() < self.error_rate:
+                return error_response(500, 'backendError', 'Backend Error')
+        return None
+
+    def list_files(self, query, headers, body):
+        matches = compile_query(query.get('q', ''))
+        page_size = min(int(query.get('pageSize', DEFAULT_PAGE_SIZE)),
+                        MAX_PAGE_SIZE)
+        start = int(query.get('pageToken', 0))
+        with self._lock:
+            found = sorted((drive_file for drive_file in self.files.values()
+                            if matches(drive_file)),
+                           key=lambda drive_file: drive_file['id'])
+        page = found[start:start + page_size]
+        response = {'kind': 'drive#fileList', 'files': page,
+                    'incompleteSearch': False}
+        if start + page_size < len(found):
+            response['nextPageToken'] = str(start + page_size)
+        return json_response(select(
+            response, query.get('fields', LIST_DEFAULT_FIELDS)))
+
+    def get_file(self, query, headers, body, file_id):
+        if file_id == 'root':
+            # The My Drive root, whose ID the fake's files list as is.
+            return file_response({'kind': 'drive#file', 'id': 'root',
+                                  'name': 'My Drive',
+                                  'mimeType': FOLDER_MIMETYPE}, query)
+        with self._lock:
+            return file_response(self._get(file_id), query)
+
+    def create_file(self, query, headers, body):
+        with self._lock:
+            return file_response(self._create(json_body(body), None), query)
+
+    def update_file(self, query, headers, body, file_id):
+        with self._lock:
+            return file_response(
+                self._update(file_id, json_body(body), None), query)
+
+    def upload(self, query, headers, body, file_id):
+        """files.create or files.update with media, for uploadType
+        media, multipart and resumable.
+        """
+        upload_type = query.get('uploadType')
+        if upload_type == 'media':
+            metadata, content = {}, body
+            media_type = headers.get('content-type')
+        elif upload_type == 'multipart':
+            boundary = content_boundary(headers.get('content-type', ''))
+            try:
+                (_, metadata), (media_headers, content) = split_multipart(
+                    body, boundary)
+            except ValueError:
+                raise FakeDriveError(400, 'badContent',
+                                     'Multipart body must have two parts')
+            metadata = json_body(metadata)
+            media_type = media_headers.get('content-type')
+        elif upload_type == 'resumable':
+            with self._lock:
+                if file_id:
+                    self._get(file_id)
+                session_id = 'session{}'.format(next(self._ids))
+                size = headers.get('x-upload-content-length')
+                self._sessions[session_id] = {
+                    'file_id': file_id,
+                    'metadata': json_body(body),
+                    'media_type': headers.get('x-upload-content-type'),
+                    'size': int(size) if size else None,
+                    'received': 0,
+                    'md5': hashlib.md5(),
+                    'fields': query.get('fields'),
+                    'file': None,
+                }
+            location = '{}upload/drive/v3/files{}?uploadType=resumable&' \
+                       'upload_id={}'.format(self.url,
+                                             '/' + file_id if file_id else '',
+                                             session_id)
+            return 200, {'Location': location}, b''
+        else:
+            raise FakeDriveError(400, 'invalidParameter',
+                                 'Invalid uploadType')
+        if media_type and 'mimeType' not in metadata:
+            metadata['mimeType'] = media_type
+        with self._lock:
+            if file_id:
+                drive_file = self._update(file_id, metadata,
+                                          content_info(content))
+            else:
+                drive_file = self._create(metadata, content_info(content))
+            return file_response(drive_file, query)
+
+    def upload_chunk(self, query, headers, body):
+        """A chunk of a resumable upload, or a query of its progress
+        ('Content-Range: bytes */size'), answered with 308 until the
+        upload is complete.
+        """
+        content_range = headers.get('content-range', '')
+        match = re.match(r'bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)$', content_range)
+        if not match:
+            raise FakeDriveError(400, 'badContent', 'Invalid Content-Range')
+        with self._lock:
+            session = self._sessions.get(query['upload_id'])
+            if session is None:
+                raise FakeDriveError(404, 'notFound', 'Upload session expired')
+            if session['file'] is None:
+                if match.group(3) != '*':
+                    session['size'] = int(match.group(3))
+                if match.group(1) is not None:
+                    start = int(match.group(1))
+                    if start > session['received']:
+                        raise FakeDriveError(400, 'badContent',
+                                             'Chunk starts after the '
+                                             'committed bytes')
+                    body = body[session['received'] - start:]
+                    session['md5'].update(body)
+                    session['received'] += len(body)
+                if session['received'] != session['size']:
+                    headers = {}
+                    if session['received']:
+                        headers['Range'] = 'bytes=0-{}'.format(
+                            session['received'] - 1)
+                    return 308, headers, b''
+                metadata = session['metadata']
+                if session['media_type'] and 'mimeType' not in metadata:
+                    metadata['mimeType'] = session['media_type']
+                info = (session['received'], session['md5'].hexdigest())
+                if session['file_id']:
+                    session['file'] = self._update(session['file_id'],
+                                                   metadata, info)
+                else:
+                    session['file'] = self._create(metadata, info)
+            return file_response(session['file'],
+                                 {'fields': session['fields']})
+
+    def start_page_token(self, query, headers, body):
+        with self._lock:
+            return json_response({'kind': 'drive#startPageToken',
+                                  'startPageToken': str(len(self._changes))})
+
+    def list_changes(self, query, headers, body):
+        page_size = min(int(query.get('pageSize', DEFAULT_PAGE_SIZE)),
+                        MAX_PAGE_SIZE)
+        with self._lock:
+            try:
+                start = int(query['pageToken'])
+            except (KeyError, ValueError):
+                raise FakeDriveError(400, 'invalid', 'Invalid pageToken')
+            if not 0 <= start <= len(self._changes):
+                raise FakeDriveError(400, 'invalid', 'Invalid pageToken')
+            changes = []
+            for file_id in self._changes[start:start + page_size]:
+                change = {'kind': 'drive#change', 'type': 'file',
+                          'fileId': file_id,
+                          'removed': file_id not in self.files}
+                if file_id in self.files:
+                    change['file'] = self.files[file_id]
+                changes.append(change)
+            response = {'kind': 'drive#changeList', 'changes': changes}
+            if start + page_size < len(self._changes):
+                response['nextPageToken'] = str(start + page_size)
+            else:
+                response['newStartPageToken'] = str(len(self._changes))
+            return json_response(select(response, query.get('fields', '*')))
+
+    def batch(self, headers, body):
+        """Answer a multipart/mixed batch request with a multipart/mixed
+        response holding the response of every sub-request.
+        """
+        with self._lock:
+            self.calls['batch'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        failure = self.injected_failure('batch')
+        if failure:
+            return failure
+        try:
+            parts = split_multipart(
+                body, content_boundary(headers.get('content-type', '')))
+        except FakeDriveError as error:
+            return error.response()
+        if len(parts) > MAX_BATCH_SIZE:
+            return error_response(400, 'limitExceeded',
+                                  'A batch holds at most {} requests'.format(
+                                      MAX_BATCH_SIZE))
+        boundary = 'batch_fakedrive_{}'.format(next(self._ids))
+        lines = []
+        for part_headers, request in parts:
+            method, path, query, request_headers, request_body = \
+                parse_http_request(request)
+            request_headers.setdefault('authorization',
+                                       headers.get('authorization'))
+            status, response_headers, content = self.handle(
+                method, path, query, request_headers, request_body)
+            content_id = part_headers.get('content-id', '<+0>')
+            lines.append('--{}\r\nContent-Type: application/http\r\n'
+                         'Content-ID: <response-{}>\r\n\r\n'
+                         'HTTP/1.1 {} {}\r\n'.format(boundary,
+                                                     content_id[1:-1],
+                                                     status,
+                                                     REASONS.get(status,
+                                                                 'Unknown')))
+            for name, value in response_headers.items():
+                lines.append('{}: {}\r\n'.format(name, value))
+            lines.append('Content-Length: {}\r\n\r\n'.format(len(content)))
+            lines.append(content.decode('utf-8'))
+            lines.append('\r\n')
+        lines.append('--{}--\r\n'.format(boundary))
+        return (200,
+                {'Content-Type': 'multipart/mixed; boundary=' + boundary},
+                ''.join(lines).encode('utf-8'))
+
+    def _get(self, file_id):
+        drive_file = self.files.get(file_id)
+        if drive_file is None:
+            raise FakeDriveError(404, 'notFound',
+                                 'File not found: {}.'.format(file_id))
+        return drive_file
+
+    def _create(self, metadata, info):
+        drive_file = {'kind': 'drive#file',
+                      'id': 'fake{:08d}'.format(next(self._ids)),
+                      'mimeType': DEFAULT_MIMETYPE,
+                      'parents': ['root'],
+                      'properties': {},
+                      'trashed': False}
+        if metadata.get('mimeType') == FOLDER_MIMETYPE:
+            info = None
+        elif info is None:
+            info = content_info(b'')
+        set_metadata(drive_file, metadata)
+        drive_file.setdefault('name', 'Untitled')
+        if info is not None:
+            drive_file['size'] = str(info[0])
+            drive_file['md5Checksum'] = info[1]
+        self.files[drive_file['id']] = drive_file
+        self._changes.append(drive_file['id'])
+        return drive_file
+
+    def _update(self, file_id, metadata, info):
+        drive_file = self._get(file_id)
+        if 'parents' in metadata:
+            raise FakeDriveError(403, 'fieldNotWritable',
+                                 'The parents field is not directly '
+                                 'writable in update requests.')
+        set_metadata(drive_file, metadata)
+        if info is not None:
+            drive_file['size'] = str(info[0])
+            drive_file['md5Checksum'] = info[1]
+        self._changes.append(file_id)
+        return drive_file
+
+
+class FakeDriveError(Exception):
+    """An API error, answered with a Drive style error response."""
+
+    def __init__(self, status, reason, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.reason = reason
+        self.message = message
+
+    def response(self):
+        return error_response(self.status, self.reason, self.message)
+
+
+class FakeDriveServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class FakeDriveHandler(BaseHTTPRequestHandler):
+    """Hands requests to the server's FakeDrive. HTTP/1.1, so clients
+    can keep connections alive.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; with Nagle's algorithm
+    # every response would wait for the client's delayed ACK.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.drive._lock:
+            self.server.drive.connections += 1
+
+    def do_GET(self):
+        headers = dict((name.lower(), value)
+                       for name, value in self.headers.items())
+        if headers.get('transfer-encoding') == 'chunked':
+            body = self.read_chunked()
+        else:
+            body = self.rfile.read(int(headers.get('content-length', 0)))
+        self.server.drive.transfer(len(body))
+        url = urlsplit(self.path)
+        status, response_headers, content = self.server.drive.handle(
+            self.command, unquote(url.path).lstrip('/'),
+            dict(parse_qsl(url.query)), headers, body)
+        self.send_response(status, REASONS.get(status))
+        for name, value in response_headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_POST = do_PUT = do_PATCH = do_DELETE = do_GET
+
+    def read_chunked(self):
+        body = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            if not size:
+                self.rfile.readline()
+                return b''.join(body)
+            body.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def log_message(self, format, *args):
+        pass
+
+
+REASONS = {200: 'OK', 308: 'Resume Incomplete', 400: 'Bad Request',
+           401: 'Unauthorized', 403: 'Forbidden', 404: 'Not Found',
+           429: 'Too Many Requests', 500: 'Internal Server Error',
+           502: 'Bad Gateway', 503: 'Service Unavailable'}
+
+
+def json_response(content, status=200):
+    return (status, {'Content-Type': 'application/json; charset=UTF-8'},
+            json.dumps(content).encode('utf-8'))
+
+
+def error_response(status, reason, message):
+    return json_response({'error': {
+        'errors': [{'domain': 'global', 'reason': reason,
+                    'message': message}],
+        'code': status,
+        'message': message}}, status)
+
+
+def file_response(drive_file, query):
+    return json_response(select(drive_file,
+                                query.get('fields') or FILE_DEFAULT_FIELDS))
+
+
+def json_body(body):
+    """Return the JSON object in a request body ({} if empty).
+
+    :type body: bytes
+    """
+    if not body:
+        return {}
+    try:
+        return json.loads(body.decode('utf-8'))
+    except ValueError:
+        raise FakeDriveError(400, 'parseError', 'Parse Error')
+
+
+def content_info(content):
+    """Return (size, MD5) of content, or None for no content.
+
+    :type content: bytes | None
+    """
+    if content is None:
+        return None
+    return len(content), hashlib.md5(content).hexdigest()
+
+
+def set_metadata(drive_file, metadata):
+    """Apply the metadata of a create or update to drive_file.
+    Properties are merged, and a property set to None is removed.
+    """
+    for key, value in metadata.items():
+        if key == 'properties':
+            properties = drive_file.setdefault('properties', {})
+            for name, prop in (value or {}).items():
+                if prop is None:
+                    properties.pop(name, None)
+                else:
+                    properties[name] = str(prop)
+        elif key not in ('id', 'kind', 'size', 'md5Checksum'):
+            drive_file[key] = value
+
+
+def parse_fields(fields):
+    """Parse a fields selector such as 'nextPageToken, files(id, name)'
+    into {'nextPageToken': None, 'files': {'id': None, 'name': None}}.
+
+    :type fields: str
+    """
+    tokens = re.findall(r"[\w*]+|[(),]", fields)
+    spec, _ = _parse_fields(tokens, 0)
+    return spec
+
+
+def _parse_fields(tokens, position):
+    spec = {}
+    while position < len(tokens) and tokens[position] != ')':
+        name = tokens[position]
+        position += 1
+        spec[name] = None
+        if position < len(tokens) and tokens[position] == '(':
+            spec[name], position = _parse_fields(tokens, position + 1)
+            position += 1
+        if position < len(tokens) and tokens[position] == ',':
+            position += 1
+    return spec, position
+
+
+def select(content, fields):
+    """Return the part of content a fields selector asks for.
+
+    :type fields: str | dict | None
+    """
+    if isinstance(fields, str):
+        fields = parse_fields(fields)
+    if fields is None or '*' in fields:
+        return content
+    if isinstance(content, list):
+        return [select(item, fields) for item in content]
+    if not isinstance(content, dict):
+        return content
+    return dict((name, select(content[name], sub))
+                for name, sub in fields.items() if name in content)
+
+
+QUERY_TOKEN = re.compile(r"\s*(?:'((?:[^'\\]|\\.)*)'|(!=|=|[(){}])|(\w+))")
+
+
+def compile_query(q):
+    """Return a predicate for the files matching the files.list query
+    q. Supports and, or, not, parentheses, '<id>' in parents, name,
+    mimeType and trashed comparisons (=, !=, contains) and
+    properties has { key='<key>' and value='<value>' }.
+
+    :type q: str
+    """
+    tokens = []
+    position = 0
+    q = q.strip()
+    while position < len(q):
+        match = QUERY_TOKEN.match(q, position)
+        if not match:
+            raise FakeDriveError(400, 'invalid', 'Invalid Value')
+        string, symbol, word = match.groups()
+        if string is not None:
+            tokens.append(('string', re.sub(r"\\(.)", r"\1", string)))
+        else:
+            tokens.append(('symbol', symbol or word))
+        position = match.end()
+    if not tokens:
+        return lambda drive_file: True
+    parser = QueryParser(tokens)
+    predicate = parser.parse_or()
+    if parser.position != len(tokens):
+        raise FakeDriveError(400, 'invalid', 'Invalid Value')
+    return predicate
+
+
+class QueryParser(object):
+    """Recursive descent parser of files.list queries."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def take(self, kind=None, value=None):
+        """Return the next token, which must be of kind and value if
+        they are given.
+        """
+        if self.position >= len(self.tokens):
+            raise FakeDriveError(400, 'invalid', 'Invalid Value')
+        token_kind, token = self.tokens[self.position]
+        if (kind and token_kind != kind) or (value and token != value):
+            raise FakeDriveError(400, 'invalid', 'Invalid Value')
+        self.position += 1
+        return token
+
+    def peek(self, value, kind='symbol'):
+        return (self.position < len(self.tokens) and
+                self.tokens[self.position] == (kind, value))
+
+    def peek_kind(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+        return None
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.peek('or'):
+            self.take()
+            terms.append(self.parse_and())
+        return lambda f: any(term(f) for term in terms)
+
+    def parse_and(self):
+        terms = [self.parse_not()]
+        while self.peek('and'):
+            self.take()
+            terms.append(self.parse_not())
+        return lambda f: all(term(f) for term in terms)
+
+    def parse_not(self):
+        if self.peek('not'):
+            self.take()
+            term = self.parse_not()
+            return lambda f: not term(f)
+        if self.peek('('):
+            self.take()
+            term = self.parse_or()
+            self.take('symbol', ')')
+            return term
+        return self.parse_term()
+
+    def parse_term(self):
+        if self.peek_kind() == 'string':
+            parent = self.take()
+            self.take('symbol', 'in')
+            self.take('symbol', 'parents')
+            return lambda f: parent in f.get('parents', ())
+        field = self.take('symbol')
+        if field == 'properties':
+            self.take('symbol', 'has')
+            self.take('symbol', '{')
+            self.take('symbol', 'key')
+            self.take('symbol', '=')
+            key = self.take('string')
+            self.take('symbol', 'and')
+            self.take('symbol', 'value')
+            self.take('symbol', '=')
+            value = self.take('string')
+            self.take('symbol', '}')
+            return lambda f: f.get('properties', {}).get(key) == value
+        if field not in ('name', 'mimeType', 'trashed', 'description'):
+            raise FakeDriveError(400, 'invalid', 'Invalid Value')
+        operator = self.take('symbol')
+        if self.peek_kind() == 'string':
+            value = self.take()
+        else:
+            value = self.take('symbol')
+            if value not in ('true', 'false'):
+                raise FakeDriveError(400, 'invalid', 'Invalid Value')
+            value = value == 'true'
+        if operator == '=':
+            return lambda f: f.get(field) == value
+        if operator == '!=':
+            return lambda f: f.get(field) != value
+        if operator == 'contains':
+            return lambda f: value in (f.get(field) or '')
+        raise FakeDriveError(400, 'invalid', 'Invalid Value')
+
+
+def content_boundary(content_type):
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not match:
+        raise FakeDriveError(400, 'badContent', 'Missing multipart boundary')
+    return match.group(1)
+
+
+def split_multipart(body, boundary):
+    """Return [(headers, body)] for the parts of a multipart body.
+    Header names are lower case.
+
+    :type body: bytes
+    :type boundary: str
+    """
+    delimiter = b'--' + boundary.encode('ascii')
+    parts = []
+    for chunk in body.split(delimiter)[1:]:
+        if chunk.startswith(b'--'):
+            break
+        chunk = chunk[2:] if chunk.startswith(b'\r\n') else chunk[1:]
+        # The line break before the next delimiter belongs to it.
+        if chunk.endswith(b'\r\n'):
+            chunk = chunk[:-2]
+        elif chunk.endswith(b'\n'):
+            chunk = chunk[:-1]
+        parts.append(split_headers(chunk))
+    return parts
+
+
+def split_headers(message):
+    """Split an HTTP or MIME message into (headers, body). Header names
+    are lower case.
+
+    :type message: bytes
+    """
+    if message.startswith(b'\r\n') or message.startswith(b'\n'):
+        head, body = b'', message.lstrip(b'\r\n')
+    else:
+        match = re.search(b'\r?\n\r?\n', message)
+        if match:
+            head, body = message[:match.start()], message[match.end():]
+        else:
+            head, body = message, b''
+    headers = {}
+    for line in head.decode('utf-8').splitlines():
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return headers, body
+
+
+def parse_http_request(request):
+    """Parse a batch sub-request into (method, path, query, headers,
+    body).
+
+    :type request: bytes
+    """
+    request_line, _, message = request.lstrip(b'\r\n').partition(b'\n')
+    method, target = request_line.decode('utf-8').split()[:2]
+    headers, body = split_headers(message)
+    url = urlsplit(target)
+    return (method, unquote(url.path).lstrip('/'), dict(parse_qsl(url.query)),
+            headers, body)
+
+
+def discovery_document(url):
+    """Return the Drive v3 discovery document of a FakeDrive at url,
+    with just the methods and parameters driveuploader uses.
+
+    :type url: str
+    """
+    string = {'type': 'string', 'location': 'query'}
+    integer = {'type': 'integer', 'format': 'int32', 'location': 'query'}
+    boolean = {'type': 'boolean', 'location': 'query'}
+    file_id = {'type': 'string', 'required': True, 'location': 'path'}
+    media_upload = {
+        'accept': ['*/*'],
+        'maxSize': '5120GB',
+        'protocols': {
+            'simple': {'multipart': True, 'path': '/upload/drive/v3/files'},
+            'resumable': {'multipart': True,
+                          'path': '/resumable/upload/drive/v3/files'},
+        },
+    }
+    media_parameters = {'ignoreDefaultVisibility': boolean,
+                        'keepRevisionForever': boolean,
+                        'ocrLanguage': string,
+                        'supportsAllDrives': boolean,
+                        'useContentAsIndexableText': boolean}
+    update_parameters = dict(media_parameters, fileId=file_id,
+                             addParents=string, removeParents=string)
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'drive:v3',
+        'name': 'drive',
+        'version': 'v3',
+        'title': 'Fake Drive API',
+        'protocol': 'rest',
+        'rootUrl': url,
+        'servicePath': 'drive/v3/',
+        'baseUrl': url + 'drive/v3/',
+        'batchPath': 'batch/drive/v3',
+        'parameters': {
+            'alt': dict(string, default='json', enum=['json']),
+            'fields': string,
+            'key': string,
+            'oauth_token': string,
+            'prettyPrint': dict(boolean, default='true'),
+            'quotaUser': string,
+            'userIp': string,
+        },
+        'schemas': {
+            'File': {'id': 'File', 'type': 'object', 'properties': {}},
+            'FileList': {'id': 'FileList', 'type': 'object',
+                         'properties': {}},
+            'ChangeList': {'id': 'ChangeList', 'type': 'object',
+                           'properties': {}},
+            'StartPageToken': {'id': 'StartPageToken', 'type': 'object',
+                               'properties': {}},
+        },
+        'resources': {
+            'files': {'methods': {
+                'list': {
+                    'id': 'drive.files.list', 'path': 'files',
+                    'httpMethod': 'GET',
+                    'parameters': {'q': string, 'spaces': string,
+                                   'corpora': string, 'orderBy': string,
+                                   'pageSize': integer,
+                                   'pageToken': string},
+                    'response': {'$ref': 'FileList'},
+                },
+                'get': {
+                    'id': 'drive.files.get', 'path': 'files/{fileId}',
+                    'httpMethod': 'GET',
+                    'parameters': {'fileId': file_id},
+                    'parameterOrder': ['fileId'],
+                    'response': {'$ref': 'File'},
+                },
+                'create': {
+                    'id': 'drive.files.create', 'path': 'files',
+                    'httpMethod': 'POST',
+                    'parameters': media_parameters,
+                    'request': {'$ref': 'File'},
+                    'response': {'$ref': 'File'},
+                    'supportsMediaUpload': True,
+                    'mediaUpload': media_upload,
+                },
+                'update': {
+                    'id': 'drive.files.update', 'path': 'files/{fileId}',
+                    'httpMethod': 'PATCH',
+                    'parameters': update_parameters,
+                    'parameterOrder': ['fileId'],
+                    'request': {'$ref': 'File'},
+                    'response': {'$ref': 'File'},
+                    'supportsMediaUpload': True,
+                    'mediaUpload': media_upload,
+                },
+            }},
+            'changes': {'methods': {
+                'getStartPageToken': {
+                    'id': 'drive.changes.getStartPageToken',
+                    'path': 'changes/startPageToken',
+                    'httpMethod': 'GET',
+                    'response': {'$ref': 'StartPageToken'},
+                },
+                'list': {
+                    'id': 'drive.changes.list', 'path': 'changes',
+                    'httpMethod': 'GET',
+                    'parameters': {
+                        'pageToken': dict(string, required=True),
+                        'pageSize': integer,
+                        'spaces': string,
+                        'includeRemoved': boolean,
+                        'restrictToMyDrive': boolean,
+                    },
+                    'parameterOrder': ['pageToken'],
+                    'response': {'$ref': 'ChangeList'},
+                },
+            }},
+        },
+    }
@@ -1,22 +1,42 @@
 """Basic testing for google drive uploader. This will upload repo
-files to a folder named 'test' in the connected google drive account.
+files to a folder named 'test' on a local fakedrive.FakeDrive, or with
+--live in the connected google drive account.
 """
 
 from __future__ import print_function
 
+import json
 import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import httplib2
 
 import driveuploader
+import fakedrive
 
 home = os.path.split(os.path.realpath(__name__))[0]
 
+if '--live' in sys.argv:
+    drive = None
+    connection = {}
+else:
+    # Keep the session journal and caches of test runs out of the repo.
+    driveuploader.SCRIPT_DIR = tempfile.mkdtemp()
+    drive = fakedrive.FakeDrive().start()
+    connection = {'api_url': drive.url, 'credentials': drive.credentials()}
+
 
 # clean up old tests, empty gdrive test folder
 ul = driveuploader.Uploader(file_list="README.md",
                             mimetype='text/plain',
                             home_dir=home,
                             description="Test file",
-                            folder="test")
+                            folder="test",
+                            **connection)
 
 test_folder_id = ul.find_folder()
 
@@ -99,7 +119,8 @@ ul = driveuploader.Uploader(file_list="README.md",
                             mimetype='text/plain',
                             home_dir=home,
                             description="Test2",
-                            folder="test")
+                            folder="test",
+                            **connection)
 ul.upload(force=True)
 files = ul.service.files().list(
     q="'{}' in parents and trashed=false and not mimeType='{}'".format(
@@ -110,4 +131,394 @@ descs = []
 for file in files:
     descs.append(file['description'])
 assert len(set(descs)) == 2  # overwritten file should have different description
-print("Tests passed.")
\ No newline at end of file
+
+
+def statuses(uploader):
+    return [result.status for result in uploader.results]
+
+
+def perf_uploader(**kwargs):
+    return driveuploader.Uploader(file_list="README.md,requirements.txt",
+                                  home_dir=home,
+                                  folder="perf",
+                                  **dict(connection, **kwargs))
+
+
+if drive is not None:
+    # test performance features, only against the fake
+    drive.calls.clear()
+    ul = perf_uploader(jobs=2, index_folder=True)
+    ul.upload()
+    assert statuses(ul) == ['uploaded', 'uploaded']
+    # one listing of the new folder instead of a lookup per file
+    assert drive.calls['drive.files.list'] == 1
+
+    # test that a transport error fails its file, not the whole run
+    def unreachable(file_class):
+        raise httplib2.ServerNotFoundError("Unable to find the server")
+    ul = perf_uploader(jobs=2)
+    ul.update_file = unreachable
+    ul.upload(force=True)
+    assert statuses(ul) == ['failed', 'failed']
+
+    # test that folders are listed in parallel, and each only once
+    folder_ids = [drive.folder(name)['id'] for name in ('left', 'right')]
+    ul = perf_uploader(jobs=4)
+    drive.calls.clear()
+    drive.latency = 0.2
+    started = time.time()
+    listers = [threading.Thread(target=ul.index_folder, args=(folder_id,))
+               for folder_id in folder_ids * 2]
+    for lister in listers:
+        lister.start()
+    for lister in listers:
+        lister.join()
+    drive.latency = 0.0
+    assert drive.calls['drive.files.list'] == 2
+    assert time.time() - started < 0.35  # not one listing after the other
+
+    # test that planning ahead looks files up one by one without batch
+    drive.calls.clear()
+    ul = perf_uploader(order=driveuploader.LARGEST_FIRST)
+    ul.upload(force=True)
+    assert statuses(ul) == ['updated', 'updated']
+    assert drive.calls['batch'] == 0
+    assert drive.calls['drive.files.list'] == 3  # the folder, each file
+
+    # test that with --order a quarter of the jobs work the large files,
+    # largest first, while the others start on the small ones
+    large = driveuploader.LARGE_FILE_SIZE
+    work = [(driveuploader.PlanAction('f{}'.format(index),
+                                      driveuploader.CREATE, '', 'folder',
+                                      None, size, 0, None), False)
+            for index, size in enumerate([1, 2 * large, 5, large, 3, 2])]
+    started = []
+
+    def process(item):
+        started.append(item[0].filepath)
+        time.sleep(0.1)
+        return item[0].filepath
+    ul = perf_uploader(jobs=4, order=driveuploader.LARGEST_FIRST)
+    assert ul.schedule(process, work) == [action.filepath
+                                          for action, _ in work]
+    assert sorted(started[:4]) == ['f1', 'f2', 'f4', 'f5']
+
+    # test that connections are kept alive, at most max_per_host of them
+    drive.calls.clear()
+    ul = perf_uploader(jobs=4, max_per_host=2)
+    ul.upload(force=True)
+    assert 1 <= ul.stats['connections_opened'] <= 2
+    assert (ul.stats['connections_opened'] +
+            ul.stats['connections_reused']) == sum(drive.calls.values())
+
+    # test batch lookups and checksums
+    drive.calls.clear()
+    ul = perf_uploader(batch=True, checksum=True)
+    ul.upload(force=True)
+    assert statuses(ul) == ['skipped', 'skipped']  # same content
+    assert drive.calls['batch'] == 1
+    assert drive.calls['drive.files.update'] == 0
+
+    # test that cached digests are reused by the next run
+    hashed = []
+    file_md5 = driveuploader.file_md5
+    driveuploader.file_md5 = lambda path: hashed.append(path) or file_md5(path)
+    perf_uploader(checksum=True).upload(force=True)
+    del hashed[:]
+    ul = perf_uploader(checksum=True)
+    ul.upload(force=True)
+    driveuploader.file_md5 = file_md5
+    assert statuses(ul) == ['skipped', 'skipped']
+    assert hashed == []
+
+    # test that the hash cache misses changed files and evicts deleted ones
+    hash_dir = tempfile.mkdtemp()
+    hash_cache = driveuploader.HashCache(os.path.join(hash_dir, 'hashes.db'))
+    for name in ('kept.txt', 'deleted.txt'):
+        path = os.path.join(hash_dir, name)
+        with open(path, 'w') as hashed_file:
+            hashed_file.write(name)
+        hash_cache.put(path, os.stat(path), file_md5(path))
+    kept = os.path.join(hash_dir, 'kept.txt')
+    assert hash_cache.get(os.stat(kept)) == file_md5(kept)
+    os.utime(kept, (1e9, 1e9))
+    assert hash_cache.get(os.stat(kept)) is None
+    os.remove(os.path.join(hash_dir, 'deleted.txt'))
+    hash_cache.evict_missing()
+    assert [row[0] for row in hash_cache._db.execute(
+        "SELECT path FROM hashes")] == [os.path.abspath(kept)]
+
+    # test hashing in a pool of processes
+    pool_dir = tempfile.mkdtemp()
+    pool_files = []
+    for index in range(4):
+        pool_files.append(os.path.join(pool_dir, 'pooled{}.txt'.format(index)))
+        with open(pool_files[-1], 'w') as pooled_file:
+            pooled_file.write('pooled' * (index + 1))
+    options = dict(connection, file_list=','.join(pool_files), folder="perf")
+    driveuploader.Uploader(**options).upload()
+    ul = driveuploader.Uploader(checksum=True, hash_workers=2, batch=True,
+                                **options)
+    ul.upload(force=True)
+    assert statuses(ul) == ['skipped'] * 4  # same content
+    for path in pool_files:
+        assert ul.hash_cache.get(os.stat(path)) == file_md5(path)
+
+    # test manifests, read in blocks smaller than their entries
+    manifest_dir = tempfile.mkdtemp()
+    real_block_size, driveuploader.MANIFEST_BLOCK_SIZE = (
+        driveuploader.MANIFEST_BLOCK_SIZE, 4)
+    try:
+        for null, content, paths in (
+                (False, b'a file.txt\r\n\nsub/b.txt', ['a file.txt',
+                                                        'sub/b.txt']),
+                (True, b'line\nbreak.txt\0\0c.txt\0', ['line\nbreak.txt',
+                                                        'c.txt'])):
+            manifest = os.path.join(manifest_dir, 'manifest')
+            with open(manifest, 'wb') as manifest_file:
+                manifest_file.write(content)
+            assert list(driveuploader.read_manifest(manifest, null)) == paths
+    finally:
+        driveuploader.MANIFEST_BLOCK_SIZE = real_block_size
+
+    # test that a failing batch is sent at most retries + 1 times
+    drive.fail(status=503, count=2, method='batch')
+    drive.calls.clear()
+    ul = perf_uploader(batch=True, retries=1)
+    ul.upload(force=True)
+    assert statuses(ul) == ['failed', 'failed']
+    assert drive.calls['batch'] == 2
+
+    # test retries of server errors
+    drive.fail(status=503, count=2)
+    ul = perf_uploader()
+    ul.upload(force=True)
+    assert statuses(ul) == ['updated', 'updated']
+    assert ul.stats['retries'] == 2
+
+    # test retries of transport errors
+    failures = [socket.timeout('timed out'),
+                httplib2.ServerNotFoundError('Unable to find the server')]
+
+    def flaky_call():
+        if failures:
+            raise failures.pop()
+        return 'sent'
+    ul = perf_uploader()
+    assert ul.retry(flaky_call) == 'sent'
+    assert ul.stats['retries'] == 2
+
+    # test that the rate limiter allows a burst, then rate per second
+    now = [100.0]
+    real_clock, driveuploader.clock = driveuploader.clock, lambda: now[0]
+    try:
+        bucket = driveuploader.TokenBucket(rate=10, burst=5)
+        assert [bucket.reserve() for _ in range(5)] == [0] * 5
+        assert abs(bucket.reserve() - 0.1) < 1e-9
+        assert abs(bucket.reserve(4) - 0.5) < 1e-9
+        now[0] += 1  # refills the 5 tokens owed, and up to the burst
+        assert bucket.reserve(5) == 0
+        now[0] += 10  # idle time never refills more than the burst
+        assert abs(bucket.reserve(6) - 0.1) < 1e-9
+    finally:
+        driveuploader.clock = real_clock
+
+    # test that the concurrency controller adds a slot per window while
+    # throughput rises, and halves once per window when rate limited
+    now = [100.0]
+    real_clock, driveuploader.clock = driveuploader.clock, lambda: now[0]
+    try:
+        controller = driveuploader.ConcurrencyController(8)
+        for sent in (1000, 2000, 4000):
+            limit = controller.limit
+            now[0] += 1
+            for _ in range(2 * limit):
+                controller.acquire()
+                controller.release(1.0, sent)
+            assert controller.limit == limit + 1
+        controller.throttled()
+        controller.throttled()
+        assert controller.limit == 2
+    finally:
+        driveuploader.clock = real_clock
+
+    # test resumable uploads, and uploading again after a failure
+    drive.fail(status=503, method='drive.files.update')
+    ul = perf_uploader(retries=0, resumable_threshold=0,
+                       chunk_size=driveuploader.CHUNK_GRANULARITY)
+    ul.upload(force=True)
+    assert statuses(ul)[0] == 'failed'
+    ul.upload(force=True)
+    assert statuses(ul) == ['updated', 'updated']
+
+    # test resumable uploads of more than one chunk
+    chunk_size = driveuploader.CHUNK_GRANULARITY
+    big_file = os.path.join(tempfile.mkdtemp(), 'chunks.bin')
+    with open(big_file, 'wb') as media:
+        media.write(os.urandom(chunk_size * 5 // 2))
+    drive.calls.clear()
+    ul = driveuploader.Uploader(file_list=big_file, folder="perf",
+                                resumable_threshold=0, chunk_size=chunk_size,
+                                **connection)
+    ul.upload()
+    assert statuses(ul) == ['uploaded']
+    assert drive.calls['drive.files.create'] == 4  # the session, 3 chunks
+    assert [drive_file['md5Checksum'] for drive_file in drive.files.values()
+            if drive_file['name'] == 'chunks.bin'] == [
+        driveuploader.file_md5(big_file)]
+
+    # test resuming an interrupted upload from its journaled offset
+    engines = [driveuploader.SYNC_ENGINE]
+    if sys.version_info >= (3, 5):
+        engines.append(driveuploader.ASYNC_ENGINE)
+    for engine in engines:
+        resumed_file = os.path.join(tempfile.mkdtemp(), engine + '.bin')
+        with open(resumed_file, 'wb') as media:
+            media.write(os.urandom(chunk_size * 5 // 2))
+        options = dict(connection, file_list=resumed_file, folder="perf",
+                       engine=engine, retries=0, resumable_threshold=0,
+                       chunk_size=chunk_size, timings=True)
+        # fail the second chunk, after the session start and first chunk
+        drive.fail(status=503, method='drive.files.create', after=2)
+        ul = driveuploader.Uploader(**options)
+        ul.upload()
+        assert statuses(ul) == ['failed']
+        session = ul.sessions.get(
+            driveuploader.LocalFile(resumed_file, None).session_key(),
+            ul.folder_id)
+        assert session['offset'] == chunk_size
+        drive.calls.clear()
+        ul = driveuploader.Uploader(**options)
+        ul.upload()
+        assert statuses(ul) == ['uploaded']
+        # the session status, then the two chunks left
+        assert drive.calls['drive.files.create'] == 3
+        # only the bytes this run sent count
+        assert ul.results[0].sent == os.path.getsize(resumed_file) - chunk_size
+        assert sum(ul.timer.calls.values()) == sum(drive.calls.values())
+        assert [drive_file['md5Checksum']
+                for drive_file in drive.files.values()
+                if drive_file['name'] == engine + '.bin'] == [
+            driveuploader.file_md5(resumed_file)]
+
+    # test nested folders with the folder cache, which is only trusted
+    # while the cached folder is still in its parent
+    def nested_uploader():
+        return driveuploader.Uploader(file_list="README.md", home_dir=home,
+                                      folder="nest/ed/path",
+                                      folder_cache=True, **connection)
+
+    def folders(name):
+        return [drive_file for drive_file in drive.files.values()
+                if drive_file['name'] == name and not drive_file['trashed']]
+    nested_uploader().upload()
+    path_folder, = folders('path')
+    assert path_folder['parents'] == [folders('ed')[0]['id']]
+    drive.calls.clear()
+    ul = nested_uploader()
+    ul.upload(force=True)
+    assert statuses(ul) == ['updated']
+    assert ul.folder_id == path_folder['id']
+    assert drive.calls['drive.files.get'] == 1  # checks the cached folder
+    path_folder['parents'] = ['root']  # moved out of nest/ed
+    ul = nested_uploader()
+    ul.upload()
+    assert statuses(ul) == ['uploaded']
+    assert ul.folder_id != path_folder['id']
+    assert [moved['parents'] for moved in folders('path')] == [
+        ['root'], [folders('ed')[0]['id']]]
+
+    # test that check creates no folders
+    tree = tempfile.mkdtemp()
+    os.makedirs(os.path.join(tree, 'sub'))
+    for path in ('top.txt', os.path.join('sub', 'nested.txt')):
+        with open(os.path.join(tree, path), 'w') as tree_file:
+            tree_file.write(path)
+    drive.calls.clear()
+    ul = driveuploader.Uploader(file_list=tree, recursive=True,
+                                folder="check/new", **connection)
+    ul.upload(check=True)
+    assert statuses(ul) == ['skipped', 'skipped']
+    assert drive.calls['drive.files.create'] == 0
+    ul.upload()
+    assert statuses(ul) == ['uploaded', 'uploaded']
+
+    # test that a folder that can't be listed only fails its own files
+    drive.fail(status=403, reason='forbidden', method='drive.files.list',
+               after=2)  # the target folder and the tree folder
+    ul.upload(check=True)
+    assert statuses(ul) == ['skipped', 'failed']
+
+    # test the remote index, kept current from the changes feed
+    ul = perf_uploader(remote_index=True)
+    ul.upload()
+    drive.calls.clear()
+    ul = perf_uploader(remote_index=True)
+    ul.upload()
+    assert statuses(ul) == ['skipped', 'skipped']
+    assert drive.calls['drive.changes.list'] == 1
+    assert drive.calls['drive.files.list'] == 1  # just the folder lookup
+
+    # test that mirrored files keep their listing order when they change
+    index = driveuploader.RemoteIndex(
+        os.path.join(tempfile.mkdtemp(), 'index.sqlite3'))
+    index.replace_folder('folder', [{'id': name, 'name': name}
+                                    for name in ('a', 'b', 'c')])
+    index.put('folder', {'id': 'b', 'name': 'b', 'size': '2'})
+    index.apply_changes([{'fileId': 'a', 'file': {
+        'id': 'a', 'name': 'a', 'parents': ['folder'],
+        'mimeType': 'text/plain'}}], 'token')
+    index.put('folder', {'id': 'd', 'name': 'd'})
+    assert [drive_file['id'] for drive_file in index.files('folder')] == [
+        'a', 'b', 'c', 'd']
+
+    # test the asyncio engine
+    if sys.version_info >= (3, 5):
+        ul = perf_uploader(engine=driveuploader.ASYNC_ENGINE)
+        ul.upload(force=True)
+        assert statuses(ul) == ['updated', 'updated']
+
+        # an unexpected error fails its file, not the other results
+        def broken_load(action):
+            if action.filepath.endswith('README.md'):
+                raise ValueError("unexpected")
+            return driveuploader.Uploader.load_file(ul, action)
+        ul = perf_uploader(engine=driveuploader.ASYNC_ENGINE)
+        ul.load_file = broken_load
+        ul.upload(force=True)
+        assert statuses(ul) == ['failed', 'updated']
+
+    # test the phase timings and the trace
+    drive.calls.clear()
+    trace = os.path.join(driveuploader.SCRIPT_DIR, 'trace.jsonl')
+    ul = perf_uploader(trace=trace)
+    ul.upload(force=True)
+    assert sum(ul.timer.calls.values()) == sum(drive.calls.values())
+    with open(trace) as lines:
+        records = [json.loads(line) for line in lines]
+    assert [record['status'] for record in records[:-1]] == statuses(ul)
+    assert 'update' in records[0]['phases']
+    assert records[-1]['calls'] == dict(ul.timer.calls)
+
+    # test the Prometheus metrics
+    metrics = os.path.join(driveuploader.SCRIPT_DIR, 'driveuploader.prom')
+    for runs in ('1', '2'):
+        if runs == '2':
+            drive.fail(status=429)
+        ul = perf_uploader(metrics=metrics)
+        ul.upload()
+        with open(metrics) as prom:
+            samples = dict(line.split() for line in prom
+                           if not line.startswith('#'))
+        # counters add up over the runs
+        assert samples['driveuploader_runs_total'] == runs
+        assert samples['driveuploader_files_total{status="skipped"}'] == str(
+            2 * int(runs))
+        assert samples['driveuploader_upload_seconds_count'] == '0'
+        assert samples['driveuploader_drive_throttled_total'] == str(
+            int(runs) - 1)
+    assert not os.path.exists(metrics + '.tmp')
+
+    drive.stop()
+
+print("Tests passed.")